@@ -156,6 +156,32 @@ if not MANAGER_CHAT_ID_KIEV:
 if not MANAGER_CHAT_ID_KR:
     logger.error("Не знайдено ID менеджера Кривий Ріг в змінних середовища")
 
+# Налаштування медіа
+# Приватний чат, куди бот при старті завантажує весь каталог медіа, щоб отримати file_id
+try:
+    MEDIA_STORAGE_CHAT_ID = int(os.getenv('MEDIA_STORAGE_CHAT_ID'))
+except (TypeError, ValueError):
+    MEDIA_STORAGE_CHAT_ID = None
+# Кількість одночасних завантажень та мінімальний інтервал між ними (секунди)
+MEDIA_PREWARM_CONCURRENCY = int(os.getenv('MEDIA_PREWARM_CONCURRENCY', '3'))
+MEDIA_PREWARM_INTERVAL = float(os.getenv('MEDIA_PREWARM_INTERVAL', '1.0'))
+# Скільки мегабайт медіа тримати в пам'яті для файлів, які ще не мають file_id
+MEDIA_MEMORY_CACHE_MB = int(os.getenv('MEDIA_MEMORY_CACHE_MB', '64'))
+# Загальний ліміт одночасних завантажень файлів у Telegram (для всіх користувачів разом)
+MEDIA_MAX_CONCURRENT_UPLOADS = int(os.getenv('MEDIA_MAX_CONCURRENT_UPLOADS', '4'))
+# Прев'ю підтем при виборі тематики: 'off' — лише клавіатура, 'album' — один альбом до 10 фото,
+# 'collage' — один колаж з усіх підтем (поки колаж не готовий — альбом)
+THEME_PREVIEW_MODE = os.getenv('THEME_PREVIEW_MODE', 'off').lower()
+# Режим статичного сервера: бот роздає медіа по HTTP, а Telegram сам забирає їх за URL.
+# MEDIA_PUBLIC_URL — адреса, за якою сервер доступний для Telegram (порожня — режим вимкнено)
+MEDIA_PUBLIC_URL = os.getenv('MEDIA_PUBLIC_URL', '').rstrip('/')
+MEDIA_SERVER_HOST = os.getenv('MEDIA_SERVER_HOST', '0.0.0.0')
+MEDIA_SERVER_PORT = int(os.getenv('MEDIA_SERVER_PORT', '8080'))
+# Адреса Bot API (наприклад, локального telegram-bot-api або тестової заглушки); порожня — api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '').rstrip('/')
+# Стеження за файлами медіа: заміна фото на диску скидає кеші без перезапуску бота ('0' — вимкнено)
+MEDIA_WATCH = os.getenv('MEDIA_WATCH', '1') == '1'
+
 # Налаштування кнопок меню
 CITIES = ['Київ', 'Кривий Ріг']
 
@@ -1,17 +1,28 @@
 # ============================================
 # ІМПОРТИ ТА НАЛАШТУВАННЯ
 # ============================================
+import asyncio
 import logging
-import os
 import re
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from config import (
     TELEGRAM_BOT_TOKEN, CITIES, EVENT_TYPES_LIST,
-    FOTO_AFISHA,CITY_CHANNELS, GENERAL_INFO, MANAGER_INFO, MANAGER_CONTACT_MESSAGES, MANAGER_CHAT_ID_KIEV, MANAGER_CHAT_ID_KR,
-    LOCATION_PDF_FILES,QWEST_PHOTOS,THEME_PHOTOS_VIPUSK, QWEST_OPIS,service_with_photo,PAKET_OPIS,MASTER_CLASS_EXPLANATION, OPIS_DODATKOVI,LOCATIONS,MASTER_CLASS_EXPLANATION2, LOCATION_INFO, THEMES, MANAGER_ERROR,THEME_INFO, THEME_BTN, Hello_World, THEME_PHOTOS, EVENT_FORMATS, HOURLY_PRICES, PAKET_PRICES, PAKET_PHOTOS, QWEST, ADDITIONAL_SERVICES_WITH_SUBMENU, ADDITIONAL_SERVICES_SINGLE, ADDITIONAL_SERVICES_PHOTOS, TAXI_PRICES, FAMILY_INFO, FAMILY_INFO_INFO2, FAMALY_TRIP
+    CITY_CHANNELS, MEDIA_STORAGE_CHAT_ID, MEDIA_PREWARM_CONCURRENCY, MEDIA_PREWARM_INTERVAL, THEME_PREVIEW_MODE, TELEGRAM_API_BASE_URL, MEDIA_WATCH, GENERAL_INFO, MANAGER_INFO, MANAGER_CONTACT_MESSAGES, MANAGER_CHAT_ID_KIEV, MANAGER_CHAT_ID_KR,
+    QWEST_OPIS,service_with_photo,PAKET_OPIS,MASTER_CLASS_EXPLANATION, OPIS_DODATKOVI,LOCATIONS,MASTER_CLASS_EXPLANATION2, LOCATION_INFO, THEMES, MANAGER_ERROR,THEME_INFO, THEME_BTN, Hello_World, EVENT_FORMATS, HOURLY_PRICES, PAKET_PRICES, QWEST, ADDITIONAL_SERVICES_WITH_SUBMENU, ADDITIONAL_SERVICES_SINGLE, TAXI_PRICES, FAMILY_INFO, FAMILY_INFO_INFO2, FAMALY_TRIP
 )
-from user_data import user_data
+from user_data import user_data, async_user_data
+from user_persistence import UserDataPersistence
+from media_cache import media_cache
+from media_derivatives import build_derivatives
+from media_video import build_videos
+from media_manifest import media_manifest, build_manifest, catalog_paths
+from media_index import media_index, build_media_index
+from media_sender import media_sender
+from media_server import media_server
+from media_bundle import media_bundle
+from media_collage import build_collages, collage_for, collage_paths
+from media_watcher import watch_media, invalidate_media
 from datetime import datetime
 import telegram.ext._updater as _updater_module
 import pandas as pd
@@ -621,10 +632,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     for key in ['choices', 'selected_city', 'additional_services', 'selected_service']:
         if key in context.user_data:
             del context.user_data[key]
-    user_data.clear_conversation_state(user.id)
+    await async_user_data.clear_conversation_state(user.id)
     
     # Зберігаємо базову інформацію про користувача
-    old_user = user_data.get_user(user.id)
+    old_user = await async_user_data.get_user(user.id)
     old_phone = old_user.get('phone_number') if old_user else None
     old_device_info = old_user.get('device_info') if old_user else None
     old_visits = old_user.get('visits', 0) if old_user else 0
@@ -635,7 +646,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_info['chat_id'] = update.effective_chat.id
     if not user_info.get('phone_number') and old_phone:
         user_info['phone_number'] = old_phone
-    user_data.add_user(user.id, user_info)
+    await async_user_data.add_user(user.id, user_info)
     
     # Скидаємо стару клавіатуру
     await update.message.reply_text(
@@ -700,15 +711,9 @@ async def event_type_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     reply_markup=create_city_keyboard()
                 )
                 return CHOOSING_CITY
-            foto_load = FOTO_AFISHA[city]
             try:
-                ext = os.path.splitext(foto_load)[1].lower()
-                if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-                    await update.message.reply_photo(open(foto_load, 'rb'))
-                elif ext in ['.mp4', '.mov', '.avi', '.mkv', '.webm']:
-                    await update.message.reply_video(open(foto_load, 'rb'))
-                else:
-                    await update.message.reply_document(open(foto_load, 'rb'))  # fallback
+                if not await media_sender.send(update.message, 'afisha', city):
+                    raise FileNotFoundError(f"Афіша для міста {city} відсутня")
 
                 await update.message.reply_text(
                     f"📅 Афіша подій у місті {city}\n"
@@ -1128,15 +1133,12 @@ async def location_chosen_inshe(update: Update, context: ContextTypes.DEFAULT_TY
 
         elif user_choice == SUGGEST_LOCATION_BUTTON:
             # Відправляємо PDF з підказками
-            pdf_path = LOCATION_PDF_FILES.get(city)
-            if pdf_path and os.path.exists(pdf_path):
-                with open(pdf_path, 'rb') as file:
-                    await update.message.reply_document(
-                        document=file,
-                        caption=f"Ось місця для проведення свята у місті {city} 👆🏻",
-                        reply_markup=create_location_keyboard(event_type)
-                    )
-            else:
+            sent = await media_sender.send(
+                update.message, 'location_pdf', city,
+                caption=f"Ось місця для проведення свята у місті {city} 👆🏻",
+                reply_markup=create_location_keyboard(event_type)
+            )
+            if not sent:
                 await update.message.reply_text(
                     "На жаль, файл з підказками тимчасово недоступний. "
                     "Будь ласка, зв'яжіться з менеджером для отримання інформації.",
@@ -1232,6 +1234,20 @@ async def theme_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             f"🎉 Ви обрали тематику: {theme}\n\n{theme_info}\n\n👇 Оберіть конкретну тематику для незабутнього свята! 🥳",
             reply_markup=create_theme2_keyboard(theme, city)
         )
+
+        # Прев'ю підтем колажем або одним альбомом — вже після клавіатури, щоб вибір не чекав на фото
+        if THEME_PREVIEW_MODE in ('album', 'collage'):
+            catalog = 'theme_vipusk' if event_type == "🎓 Випускний" else 'theme'
+            collage = collage_for(catalog, city, theme) if THEME_PREVIEW_MODE == 'collage' else None
+            try:
+                if collage:
+                    await media_sender.send_path(update.message, collage[0], 'photo', caption=collage[1])
+                else:
+                    await media_sender.send_album(
+                        update.message, catalog, city, theme, THEME_BTN.get(city, {}).get(theme, []), max_albums=1
+                    )
+            except Exception as e:
+                logger.warning(f"Не вдалося відправити прев'ю підтем для {theme}: {str(e)}")
         return CHOOSING_THEME2
 
     except Exception as e:
@@ -1296,31 +1312,16 @@ async def theme2_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         city = next((choice['value'] for choice in user_choices if choice['type'] == "Місто"), None)
         event_type = next((choice['value'] for choice in user_choices if choice['type'] == "Тип події"), None)
         # Отримуємо посилання на фото для підтеми з урахуванням міста
-        photo_url = None
-        if city:
-            if event_type == "🎓 Випускний":
-                photo_url = THEME_PHOTOS_VIPUSK.get(city, {}).get(theme, {}).get(subtheme)
-                logger.info("VIPUSK")
-            else:
-                photo_url = THEME_PHOTOS.get(city, {}).get(theme, {}).get(subtheme)
-                logger.info("NOT VIPUSK")
-        
+        catalog = 'theme_vipusk' if event_type == "🎓 Випускний" else 'theme'
+        logger.info("VIPUSK" if catalog == 'theme_vipusk' else "NOT VIPUSK")
+
         # Відправляємо фото з описом
-        if photo_url:
-            if os.path.exists(photo_url):
-                with open(photo_url, 'rb') as photo:
-                    await update.message.reply_photo(
-                        photo=photo,
-                        caption=f"\n🎉 Чудовий вибір! 😍\nОберіть далі:",
-                        reply_markup=create_theme_details_keyboard()
-                    )
-            else:
-                await update.message.reply_photo(
-                    photo=photo_url,
-                    caption=f"\nЧудовий вибір! 🌟\n👇 Оберіть далі:",
-                    reply_markup=create_theme_details_keyboard()
-                )
-        else:
+        sent = await media_sender.send(
+            update.message, catalog, city, theme, subtheme,
+            caption=f"\n🎉 Чудовий вибір! 😍\nОберіть далі:",
+            reply_markup=create_theme_details_keyboard()
+        )
+        if not sent:
             await update.message.reply_text(
                 f"🎨 {subtheme}\n\nЧудовий вибір! Оберіть:",
                 reply_markup=create_theme_details_keyboard()
@@ -1428,25 +1429,13 @@ async def format_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         if subtheme:
             # --- Додаємо отримання міста для фото підтеми (BACK_BUTTON) ---
             city = next((choice['value'] for choice in user_choices if choice['type'] == "Місто"), None)
-            photo_url = None
-            if city:
-                photo_url = THEME_PHOTOS.get(city, {}).get(theme, {}).get(subtheme)
             # Відправляємо фото з описом
-            if photo_url:
-                if os.path.exists(photo_url):
-                    with open(photo_url, 'rb') as photo:
-                        await update.message.reply_photo(
-                            photo=photo,
-                            caption=f"🎨 {subtheme}\n\nОберіть:",
-                            reply_markup=create_theme_details_keyboard()
-                        )
-                else:
-                    await update.message.reply_photo(
-                        photo=photo_url,
-                        caption=f"🎨 {subtheme}\n\nОберіть:",
-                        reply_markup=create_theme_details_keyboard()
-                    )
-            else:
+            sent = await media_sender.send(
+                update.message, 'theme', city, theme, subtheme,
+                caption=f"🎨 {subtheme}\n\nОберіть:",
+                reply_markup=create_theme_details_keyboard()
+            )
+            if not sent:
                 await update.message.reply_text(
                     f"🎨 {subtheme}\n\nОберіть:",
                     reply_markup=create_theme_details_keyboard()
@@ -1713,23 +1702,19 @@ async def package_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         price = PAKET_PRICES[city][event_type][text]
         
         # Отримуємо шлях до фото пакету
-        photo_path = PAKET_PHOTOS[city][event_type][text]
         opis = PAKET_OPIS[city][event_type][text]
         
-        # Перевіряємо наявність файлу
-        if os.path.exists(photo_path):
-            # Відправляємо фото пакету
-            with open(photo_path, 'rb') as photo:
-                await update.message.reply_photo(
-                    photo=photo,
-                    caption=f"🎉 Вибрано пакет: {text}\n💰 Вартість: {price} грн\n\n"
-                            f"{opis}\n\n"
-                            f"Чудовий вибір! 👍",
-                    reply_markup=create_final_keyboard()
-                )
-        else:
+        # Відправляємо фото пакету, якщо воно є
+        sent = await media_sender.send(
+            update.message, 'paket', city, event_type, text,
+            caption=f"🎉 Вибрано пакет: {text}\n💰 Вартість: {price} грн\n\n"
+                    f"{opis}\n\n"
+                    f"Чудовий вибір! 👍",
+            reply_markup=create_final_keyboard()
+        )
+        if not sent:
             # Якщо файл не знайдено, відправляємо повідомлення без фото
-            logger.warning(f"Файл не знайдено: {photo_path}")
+            logger.warning(f"Файл для пакету не знайдено: {city}/{event_type}/{text}")
             await update.message.reply_text(
                 f"🎉 Вибрано пакет: {text}\n💰 Вартість: {price} грн\n\n"
                 f"{opis}\n\n"
@@ -1795,16 +1780,13 @@ async def qwest_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         context.user_data['selected_city'] = city
         
         # --- ВИВІД ФОТО ТА ОПИСУ ---
-        photo_path = QWEST_PHOTOS.get(city, {}).get(text)
         opis = QWEST_OPIS.get(city, {}).get(text, '')
-        if photo_path:
-            try:
-                with open(photo_path, 'rb') as photo:
-                    await update.message.reply_photo(photo, caption=opis if opis else None)
-            except Exception as e:
-                logger.warning(f"[QWEST_PHOTOS] Не вдалося відкрити фото {photo_path}: {str(e)}")
-                await update.message.reply_text(f"Фото для квесту не знайдено. {opis if opis else ''}")
-        else:
+        try:
+            sent = await media_sender.send(update.message, 'qwest', city, None, text, caption=opis if opis else None)
+        except Exception as e:
+            logger.warning(f"[QWEST_PHOTOS] Не вдалося відправити фото квесту {text}: {str(e)}")
+            sent = None
+        if not sent:
             await update.message.reply_text(f"Фото для квесту не знайдено. {opis if opis else ''}")
         # --- КІНЕЦЬ ВИВОДУ ФОТО ТА ОПИСУ ---
         
@@ -2230,32 +2212,15 @@ async def additional_services_chosen(update: Update, context: ContextTypes.DEFAU
                 logger.info(f"[ADDITIONAL_SERVICES] Додано просту послугу: {service_name} = {price_text}")
                 #Прості послуги з фото
                 if service_name in service_with_photo:
-                    city_key = None
-                    normalized_city = city.replace('-', '').replace(' ', '').upper()
-                    for ck in ADDITIONAL_SERVICES_PHOTOS.keys():
-                        if ck.replace('-', '').replace(' ', '').upper() == normalized_city:
-                            city_key = ck
-                            break
-                    if city_key and "ГЕНЕРАТОР" in ADDITIONAL_SERVICES_PHOTOS[city_key]:
-                        photo_path = ADDITIONAL_SERVICES_PHOTOS[city_key]["ГЕНЕРАТОР"].get(service_name)
-                        logger.info(f"[ADDITIONAL_SERVICES] Шлях до фото генератора: {photo_path}")
-                        if photo_path and os.path.exists(photo_path):
-                            logger.info(f"[ADDITIONAL_SERVICES] Файл {photo_path} існує")
-                            await update.message.reply_photo(
-                                photo=open(photo_path, 'rb'),
-                                caption=f"Послугу '{service_name}' додано до вашого вибору! 🎁\n💰 Вартість: {price_text}",
-                                reply_markup=create_additional_services_keyboard(city, context)
-                            )
-                            return CHOOSING_ADDITIONAL_SERVICES
-                        else:
-                            logger.warning(f"[ADDITIONAL_SERVICES] Файл {photo_path} не існує або не знайдено")
-                            await update.message.reply_text(
-                                f"Послугу '{service_name}' додано до вашого вибору! 🎁\n💰 Вартість: {price_text}",
-                                reply_markup=create_additional_services_keyboard(city, context)
-                            )
-                            return CHOOSING_ADDITIONAL_SERVICES
+                    sent = await media_sender.send(
+                        update.message, 'additional', city, "ГЕНЕРАТОР", service_name,
+                        caption=f"Послугу '{service_name}' додано до вашого вибору! 🎁\n💰 Вартість: {price_text}",
+                        reply_markup=create_additional_services_keyboard(city, context)
+                    )
+                    if sent:
+                        return CHOOSING_ADDITIONAL_SERVICES
                     else:
-                        logger.warning(f"[ADDITIONAL_SERVICES] Не знайдено фото для генератора у місті {city}")
+                        logger.warning(f"[ADDITIONAL_SERVICES] Не знайдено фото для '{service_name}' у місті {city}")
                         await update.message.reply_text(
                             f"Послугу '{service_name}' додано до вашого вибору! 🎁\n💰 Вартість: {price_text}",
                             reply_markup=create_additional_services_keyboard(city, context)
@@ -2330,68 +2295,31 @@ async def additional_services_chosen(update: Update, context: ContextTypes.DEFAU
                         if text not in context.user_data['additional_services'][service]:
                             context.user_data['additional_services'][service].append(text)
                         logger.info(f"[ADDITIONAL_SERVICES] Збережено вибір опції")
-                        # Визначаємо категорію послуги та знаходимо відповідне фото
-                        photo_path = None
-                        option_name = option.split(" - ")[0].strip()
-                        logger.info(f"[ADDITIONAL_SERVICES] Опція для пошуку фото: {option_name}")
-                        city_key = None
-                        normalized_city = city.replace('-', '').replace(' ', '').upper()
-                        for ck in ADDITIONAL_SERVICES_PHOTOS.keys():
-                            if ck.replace('-', '').replace(' ', '').upper() == normalized_city:
-                                city_key = ck
-                                break
-                        if city_key and "ГЕНЕРАТОР" in ADDITIONAL_SERVICES_PHOTOS[city_key]:
-                            photo_path = ADDITIONAL_SERVICES_PHOTOS[city_key]["ГЕНЕРАТОР"].get(service)
-                        service_type = None
-                        for key in ADDITIONAL_SERVICES_PHOTOS[city_key]:
-                            if key.upper() in service.upper() or service.upper() in key.upper():
-                                service_type = key
-                                break
+                        # Категорія послуги та фото опції визначені заздалегідь в індексі медіа
+                        service_type, photo_path = media_index.additional_option(city, service, option)
                         if not service_type:
-                            if "ГЕНЕРАТОР" in service.upper() or "БУЛЬБАШОК" in service.upper():
-                                service_type = "ГЕНЕРАТОР"
-                            else:
-                                logger.error(f"[ADDITIONAL_SERVICES] Не знайдено тип послуги '{service}' для міста '{city_key}'")
-                                await update.message.reply_text("Фото для цієї послуги не знайдено (тип)", 
-                                reply_markup=create_service_options_keyboard(city, service))
-                                return CHOOSING_ADDITIONAL_SERVICES
-                        photo_dict = ADDITIONAL_SERVICES_PHOTOS[city_key][service_type]
-                        base_name = option_name.split('-')[0].strip().upper()
-                        photo_path = None
-                        for name in photo_dict:
-                            if name.upper() in base_name or base_name in name.upper():
-                                photo_path = photo_dict[name]
-                                break
+                            logger.error(f"[ADDITIONAL_SERVICES] Не знайдено тип послуги '{service}' для міста '{city}'")
+                            await update.message.reply_text("Фото для цієї послуги не знайдено (тип)", 
+                            reply_markup=create_service_options_keyboard(city, service))
+                            return CHOOSING_ADDITIONAL_SERVICES
                         if photo_path:
                             logger.info(f"[ADDITIONAL_SERVICES] Знайдено шлях до фото: {photo_path}")
-                            if os.path.exists(photo_path):
-                                logger.info(f"[ADDITIONAL_SERVICES] Файл {photo_path} існує")
-                                logger.info(f"[DEBUG] city: '{city}', MASTER_CLASS_EXPLANATION2 keys: {list(MASTER_CLASS_EXPLANATION2.keys())}")
-                                caption = f"{opis} \n{text} для послуги '{service}' додано до вашого вибору"
-                                # Додаємо ціну за майстра для будь-яких варіацій майстер-класу
-                                if (
-                                    (service_type and 'МАЙСТЕР' in service_type.upper())
-                                    or (service and 'МАЙСТЕР' in service.upper())
-                                ):
-                                    caption += f" + ціна за майстра {MASTER_CLASS_EXPLANATION2[city]['МАЙСТЕР']}"
-                                await update.message.reply_photo(
-                                    photo=open(photo_path, 'rb')
-                                )
-                                await update.message.reply_text(
-                                    caption,
-                                    reply_markup=create_service_options_keyboard(city, service)
-                                )
-                                return CHOOSING_ADDITIONAL_SERVICES
-                            else:
-                                logger.warning(f"[ADDITIONAL_SERVICES] Файл {photo_path} не існує")
-                                await update.message.reply_text(
-                                    f"{opis} \n"
-                                    f"{text} для послуги '{service}' додано до вашого вибору! 🎁",
-                                    reply_markup=create_service_options_keyboard(city, service)
-                                )
-                                return CHOOSING_ADDITIONAL_SERVICES
+                            logger.info(f"[DEBUG] city: '{city}', MASTER_CLASS_EXPLANATION2 keys: {list(MASTER_CLASS_EXPLANATION2.keys())}")
+                            caption = f"{opis} \n{text} для послуги '{service}' додано до вашого вибору"
+                            # Додаємо ціну за майстра для будь-яких варіацій майстер-класу
+                            if (
+                                (service_type and 'МАЙСТЕР' in service_type.upper())
+                                or (service and 'МАЙСТЕР' in service.upper())
+                            ):
+                                caption += f" + ціна за майстра {MASTER_CLASS_EXPLANATION2[city]['МАЙСТЕР']}"
+                            await media_sender.send(update.message, 'additional_option', city, service, option)
+                            await update.message.reply_text(
+                                caption,
+                                reply_markup=create_service_options_keyboard(city, service)
+                            )
+                            return CHOOSING_ADDITIONAL_SERVICES
                         else:
-                            logger.warning(f"[ADDITIONAL_SERVICES] Не знайдено шлях до фото для опції {option_name}")
+                            logger.warning(f"[ADDITIONAL_SERVICES] Не знайдено фото для опції {option}")
                             await update.message.reply_text(
                                 f"{opis} \n"
                                 f"'{text}' для послуги '{service}' додано до вашого вибору! 🎁",
@@ -2756,9 +2684,9 @@ async def summary_chosen_contact_phone(update: Update, context: ContextTypes.DEF
                 reply_markup=create_city_keyboard()
             )
             # --- ЗБЕРЕЖЕННЯ КОНТАКТУ В БАЗІ ДАНИХ ---
-            user_info = get_unified_user_info(user, user_data.get_user(user.id), update)
+            user_info = get_unified_user_info(user, await async_user_data.get_user(user.id), update)
             user_info['phone_number'] = phone
-            user_data.add_user(user.id, user_info)
+            await async_user_data.add_user(user.id, user_info)
             logger.info(f"[SUMMARY_CONTACT] Контакт збережено для user_id={user.id}")
             context.user_data.clear()
             return CHOOSING_CITY
@@ -2794,12 +2722,12 @@ async def save_state(update: Update, context: ContextTypes.DEFAULT_TYPE, state:
             'last_state': state,
             'last_update': datetime.now().isoformat()
         }
-        user_data.save_conversation_state(update.effective_user.id, {'state': state_inner})
+        await async_user_data.save_conversation_state(update.effective_user.id, {'state': state_inner})
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Скасування розмови"""
     if user_data and update.effective_user:
-        user_data.clear_conversation_state(update.effective_user.id)
+        await async_user_data.clear_conversation_state(update.effective_user.id)
     
     await update.message.reply_text(
         'Виникла помилка. Щоб почати спочатку, використайте команду /start'
@@ -2856,8 +2784,13 @@ async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
     if user_id not in [MANAGER_CHAT_ID_KIEV, MANAGER_CHAT_ID_KR]:
         await update.message.reply_text("⛔ Доступ заборонено")
         return
+    # Потрібний порядок колонок; він же — перелік полів, які читаються з бази
+    columns = [
+        'user_id', 'username', 'first_name', 'last_name', 'language_code', 'phone_number',
+        'is_bot', 'status', 'last_update', 'created_at', 'chat_id', 'type', 'city', 'order_count', 'visits', 'device_info'
+    ]
     data = []
-    for uid, info in user_data.users.items():
+    async for uid, info in async_user_data.iter_users(columns):
         try:
             numeric_uid = int(uid)
         except (ValueError, TypeError):
@@ -2882,10 +2815,6 @@ async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
         }
         data.append(row)
     # Формуємо DataFrame з потрібним порядком колонок
-    columns = [
-        'user_id', 'username', 'first_name', 'last_name', 'language_code', 'phone_number',
-        'is_bot', 'status', 'last_update', 'created_at', 'chat_id', 'type', 'city', 'order_count', 'visits', 'device_info'
-    ]
     df = pd.DataFrame(data, columns=columns)
     buffer = BytesIO()
     df.to_excel(buffer, index=False)
@@ -2912,7 +2841,7 @@ async def broadcast_all_command(update: Update, context: ContextTypes.DEFAULT_TY
     msg_text = ' '.join(context.args)
     media_msg = update.message.reply_to_message
     sent, failed = 0, 0
-    for uid, info in user_data.users.items():
+    async for uid, info in async_user_data.iter_users(['chat_id']):
         chat_id = info.get('chat_id')
         if not chat_id:
             continue
@@ -3008,6 +2937,82 @@ async def send_summary_to_manager(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text(MANAGER_ERROR)
 
 
+async def prepare_media(application: Application) -> None:
+    """Зводить дублікати, готує оптимізовані копії зображень, а потім прогріває кеш file_id"""
+    paths = catalog_paths()
+    if media_bundle.loaded:
+        # Архів збирається разом з маніфестом і оптимізованими копіями — перебудовувати нічого
+        stale = await asyncio.to_thread(media_bundle.stale_paths)
+        if stale:
+            logger.warning(f"[MEDIA_BUNDLE] {len(stale)} файлів змінилися після збирання архіву, читаємо їх з диска")
+            media_bundle.discard(stale)
+        media_cache.set_aliases(media_manifest.aliases)
+        paths = list(dict.fromkeys(media_cache.canonical(path) for path in paths))
+    else:
+        # Хешування та перекодування важкі для CPU та диска, тому виконуємо їх поза циклом подій
+        stale = await asyncio.to_thread(media_manifest.stale_paths, paths) if media_manifest.loaded else None
+        if stale is None or stale:
+            if stale:
+                logger.warning(f"[MEDIA_MANIFEST] Маніфест застарів ({len(stale)} файлів змінено), перебудовуємо")
+            manifest = await asyncio.to_thread(build_manifest, paths)
+            await asyncio.to_thread(manifest.save)
+            media_manifest.replace(manifest)
+            # Індекс будувався за старим маніфестом при імпорті — нові файли в ньому ще відсутні
+            media_index.replace(await asyncio.to_thread(build_media_index, media_manifest))
+        media_cache.set_aliases(media_manifest.aliases)
+        paths = list(dict.fromkeys(media_cache.canonical(path) for path in paths))
+        await asyncio.to_thread(build_derivatives, paths)
+        await asyncio.to_thread(build_videos, paths)
+    if THEME_PREVIEW_MODE == 'collage':
+        await asyncio.to_thread(build_collages, media_index, THEME_BTN)
+        paths += collage_paths()
+    if MEDIA_WATCH:
+        # Не через application.create_task: Application.stop() чекає завершення таких задач,
+        # а спостереження за файлами нескінченне — задачу скасовує post_shutdown
+        background_tasks.append(asyncio.create_task(
+            watch_media(catalog_paths(), lambda changed: refresh_media(application, changed)), name="watch_media"
+        ))
+    if MEDIA_STORAGE_CHAT_ID is None:
+        logger.info("[PREWARM] MEDIA_STORAGE_CHAT_ID не задано, попереднє завантаження медіа вимкнено")
+        return
+    await media_sender.prewarm(application.bot, MEDIA_STORAGE_CHAT_ID, paths,
+                               MEDIA_PREWARM_CONCURRENCY, MEDIA_PREWARM_INTERVAL)
+
+async def refresh_media(application: Application, changed: set) -> None:
+    """Оновлює кеші після зміни файлів медіа на диску і заново прогріває лише змінені файли"""
+    try:
+        paths = await invalidate_media(changed)
+        if THEME_PREVIEW_MODE == 'collage':
+            await asyncio.to_thread(build_collages, media_index, THEME_BTN)
+            paths += collage_paths()
+        if MEDIA_STORAGE_CHAT_ID is not None and paths:
+            await media_sender.prewarm(application.bot, MEDIA_STORAGE_CHAT_ID, paths,
+                                       MEDIA_PREWARM_CONCURRENCY, MEDIA_PREWARM_INTERVAL)
+    except Exception as e:
+        logger.error(f"[MEDIA_WATCH] Помилка оновлення медіа: {e}")
+
+# Нескінченні фонові задачі, які зупиняються в post_shutdown
+background_tasks = []
+
+async def post_init(application: Application) -> None:
+    """Фонові задачі, що запускаються після ініціалізації бота"""
+    if media_server.enabled:
+        await media_server.start()
+    # Прогрів може тривати хвилини — задачу скасовує post_shutdown, а не чекає Application.stop()
+    background_tasks.append(asyncio.create_task(prepare_media(application), name="prepare_media"))
+    background_tasks.append(asyncio.create_task(async_user_data.run_flusher(), name="flush_states"))
+    background_tasks.append(asyncio.create_task(media_cache.run_flusher(), name="flush_media_cache"))
+
+async def post_shutdown(application: Application) -> None:
+    """Звільнення ресурсів після зупинки бота"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await asyncio.to_thread(media_cache.flush)
+    await async_user_data.close()
+    await media_server.stop()
+
         
 # ============================================
 # ОСНОВНА ФУНКЦІЯ
@@ -3015,7 +3020,16 @@ async def send_summary_to_manager(update: Update, context: ContextTypes.DEFAULT_
 
 def main():
     """Запуск бота"""
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    builder = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        # Стани розмов і context.user_data переживають перезапуск бота
+        .persistence(UserDataPersistence(async_user_data))
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        # Власний сервер Bot API (або заглушка для локальної перевірки)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
     
     # Налаштування обробника розмови
     conv_handler = ConversationHandler(
@@ -3052,6 +3066,8 @@ def main():
             
         },
         fallbacks=[CommandHandler('cancel', cancel), CommandHandler('start', start)],
+        name='booking',
+        persistent=True,
     )
     
     application.add_handler(conv_handler)
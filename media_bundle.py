@@ -0,0 +1,185 @@
+import os
+import mmap
+import json
+import struct
+import logging
+from typing import Dict, Optional, List, Tuple
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Архів з усіма медіа каталогу; будується командою `python media_bundle.py` під час деплою
+BUNDLE_FILE = os.getenv('MEDIA_BUNDLE_FILE', 'media.bundle')
+
+MAGIC = b'MEDIABN1'
+# Мініатюра перекодованого відео пакується окремим записом під шляхом відео з цим суфіксом
+THUMBNAIL_SUFFIX = '#thumbnail'
+# Заголовок: сигнатура, зміщення та довжина JSON-індексу в кінці файлу
+HEADER = struct.Struct('<8sQQ')
+# Дані кожного файлу починаються з нової сторінки пам'яті
+ALIGN = mmap.PAGESIZE
+
+
+class MediaBundle:
+    """Один файл з усіма медіа каталогу, відображений у пам'ять.
+
+    Індекс зберігає для кожного шляху зміщення та довжину даних у архіві, а також розмір
+    і mtime оригіналу — ними кеш file_id перевіряє файл, навіть якщо на диску його немає.
+    Для перекодованих відео п'ятим елементом іде їхній опис (тривалість, розміри, мініатюра).
+    Читання — це зріз memoryview без копіювання; сторінки підтягує ОС при першому зверненні.
+    """
+
+    def __init__(self, filename: str = BUNDLE_FILE):
+        self.filename = filename
+        self.index: Dict[str, List[int]] = {}
+        self._mmap: Optional[mmap.mmap] = None
+        self._view: Optional[memoryview] = None
+        self.load()
+
+    @property
+    def loaded(self) -> bool:
+        return self._view is not None
+
+    def load(self):
+        """Відображає архів у пам'ять і читає індекс"""
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as file:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise ValueError("невідомий формат архіву")
+            self.index = json.loads(self._mmap[index_offset:index_offset + index_length].decode('utf-8'))
+            self._view = memoryview(self._mmap)
+            logger.info(f"[MEDIA_BUNDLE] Відображено {self.filename}: {len(self.index)} файлів, "
+                        f"{len(self._mmap) / 1024 / 1024:.1f} MB")
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f"[MEDIA_BUNDLE] Помилка відкриття {self.filename}: {e}")
+            self.close()
+
+    def close(self):
+        self.index = {}
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.index
+
+    def view(self, path: str) -> Optional[memoryview]:
+        """Вміст файлу як зріз відображеної пам'яті (без копіювання) або None"""
+        entry = self.index.get(path)
+        if entry is None or self._view is None:
+            return None
+        offset, length = entry[0], entry[1]
+        return self._view[offset:offset + length]
+
+    def stat(self, path: str) -> Optional[Tuple[int, int]]:
+        """(розмір, mtime_ns) оригіналу на момент збирання архіву"""
+        entry = self.index.get(path)
+        return (entry[2], entry[3]) if entry else None
+
+    def video_info(self, path: str) -> Optional[dict]:
+        """Опис перекодованого відео з архіву в тому ж вигляді, що й media_video.video_info()"""
+        entry = self.index.get(path)
+        if entry is None or len(entry) < 5:
+            return None
+        return dict(entry[4], path=path, thumbnail=path + THUMBNAIL_SUFFIX)
+
+    def stale_paths(self) -> List[str]:
+        """Файли, які є на диску, але змінилися після збирання архіву"""
+        stale = []
+        for path, entry in self.index.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Файлу на диску немає — архів і є джерелом
+                continue
+            if (st.st_size, st.st_mtime_ns) != (entry[2], entry[3]):
+                stale.append(path)
+        return stale
+
+    def discard(self, paths: List[str]) -> None:
+        """Прибирає файли з індексу — далі вони читатимуться з диска"""
+        for path in paths:
+            self.index.pop(path, None)
+            self.index.pop(path + THUMBNAIL_SUFFIX, None)
+
+
+def build_bundle(paths: List[str], filename: str = BUNDLE_FILE) -> int:
+    """Пакує файли каталогу в архів; повертає кількість упакованих шляхів.
+
+    Для фото й відео пакується оптимізована копія (якщо build_derivatives() та build_videos()
+    її вже зробили), однаковий вміст зберігається один раз. Для відео разом з копією
+    пакуються мініатюра та параметри, потрібні для відправки.
+    """
+    from media_dedup import content_hash
+    from media_derivatives import derivative_path
+    from media_cache import media_kind
+    from media_video import build_video
+
+    index: Dict[str, List[int]] = {}
+    stored: Dict[str, Tuple[int, int]] = {}
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as out:
+        def pack(source: str) -> Tuple[int, int]:
+            digest = content_hash(source)
+            if digest not in stored:
+                out.write(b'\0' * (-out.tell() % ALIGN))
+                offset = out.tell()
+                with open(source, 'rb') as file:
+                    length = out.write(file.read())
+                stored[digest] = (offset, length)
+            return stored[digest]
+
+        out.write(HEADER.pack(MAGIC, 0, 0))
+        for path in dict.fromkeys(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            kind = media_kind(path)
+            video = build_video(path) if kind == 'video' else None
+            source = path
+            if kind == 'photo':
+                source = derivative_path(path)
+            elif video:
+                source = video['path']
+            index[path] = [*pack(source), st.st_size, st.st_mtime_ns]
+            if video:
+                index[path].append({key: video[key] for key in ('duration', 'width', 'height')})
+                index[path + THUMBNAIL_SUFFIX] = [*pack(video['thumbnail']), st.st_size, st.st_mtime_ns]
+        index_data = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        index_offset = out.tell()
+        out.write(index_data)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, index_offset, len(index_data)))
+    os.replace(tmp, filename)
+    logger.info(f"[MEDIA_BUNDLE] Упаковано {len(index)} шляхів ({len(stored)} унікальних файлів) "
+                f"у {filename}: {os.path.getsize(filename) / 1024 / 1024:.1f} MB")
+    return len(index)
+
+
+# Створення глобального екземпляра
+media_bundle = MediaBundle()
+
+
+if __name__ == '__main__':
+    # Збірка архіву разом з оптимізованими копіями та маніфестом: python media_bundle.py
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    from media_derivatives import build_derivatives
+    from media_manifest import build_manifest, catalog_paths
+    from media_video import build_videos
+    catalog = catalog_paths()
+    build_derivatives(catalog)
+    build_videos(catalog)
+    build_manifest(catalog).save()
+    media_bundle.close()
+    build_bundle(catalog)
@@ -0,0 +1,205 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional, Any, List, Tuple
+from datetime import datetime
+from pymongo import UpdateOne, DeleteOne
+from pymongo.collection import Collection
+from telegram import Message
+from user_data import user_data
+from media_bundle import media_bundle
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+VIDEO_EXTENSIONS = ['.mp4', '.mov', '.avi', '.mkv', '.webm']
+# Як часто нові file_id записуються в MongoDB або media_cache.json (секунди)
+MEDIA_CACHE_FLUSH_INTERVAL = float(os.getenv('MEDIA_CACHE_FLUSH_INTERVAL', '5'))
+
+
+class MediaCache:
+    """Кеш file_id Telegram для локальних медіафайлів.
+
+    Запис прив'язаний до шляху та перевіряється за розміром і mtime файлу,
+    тож заміна файлу автоматично робить старий file_id недійсним.
+    Дублікати (див. media_dedup) мапляться на канонічний файл і ділять з ним один file_id.
+    put() і forget() лише змінюють словник у пам'яті; у сховище зміни потрапляють пакетом
+    з flush(), який викликає run_flusher() поза циклом подій.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None, filename: str = "media_cache.json"):
+        self.entries: Dict[str, dict] = {}
+        self.filename = filename
+        self.collection = collection
+        self.aliases: Dict[str, str] = {}
+        # Незаписані зміни: шлях -> запис або None (видалити)
+        self._pending: Dict[str, Optional[dict]] = {}
+        self._lock = threading.Lock()
+        # (розмір, mtime_ns) вже перевірених файлів: get() не звертається до диска на кожну відправку
+        self._stats: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.load_data()
+
+    def load_data(self):
+        """Завантаження кешу з MongoDB або локального файлу"""
+        if self.collection is not None:
+            try:
+                self.entries = {doc['_id']: {k: v for k, v in doc.items() if k != '_id'}
+                                for doc in self.collection.find({})}
+                logger.info(f"Кеш медіа завантажено з MongoDB: {len(self.entries)} записів")
+                return
+            except Exception as e:
+                logger.error(f"Помилка завантаження кешу медіа з MongoDB: {e}")
+                self.collection = None
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as file:
+                    self.entries = json.load(file)
+                logger.info(f"Кеш медіа завантажено з локального файлу: {len(self.entries)} записів")
+            except (json.JSONDecodeError, OSError) as e:
+                logger.error(f"Помилка читання кешу медіа: {e}")
+                self.entries = {}
+
+    def _save_local(self):
+        """Збереження кешу в локальний файл"""
+        try:
+            with self._lock:
+                data = dict(self.entries)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.filename)
+        except Exception as e:
+            logger.error(f"Помилка збереження кешу медіа локально: {e}")
+
+    def flush(self) -> int:
+        """Записує накопичені зміни одним bulk_write або одним перезаписом файлу; повертає їх кількість"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        if self.collection is not None:
+            requests = [UpdateOne({'_id': path}, {'$set': entry}, upsert=True) if entry is not None
+                        else DeleteOne({'_id': path}) for path, entry in pending.items()]
+            try:
+                self.collection.bulk_write(requests, ordered=False)
+                return len(pending)
+            except Exception as e:
+                logger.error(f"Помилка збереження кешу медіа в MongoDB: {e}")
+                with self._lock:
+                    # Повертаємо в буфер, не затираючи зміни, що надійшли під час запису
+                    self._pending = {**pending, **self._pending}
+        self._save_local()
+        return len(pending)
+
+    async def run_flusher(self) -> None:
+        """Фонова задача: скидає зміни кешу раз на MEDIA_CACHE_FLUSH_INTERVAL"""
+        while True:
+            await asyncio.sleep(MEDIA_CACHE_FLUSH_INTERVAL)
+            await asyncio.to_thread(self.flush)
+
+    def set_aliases(self, aliases: Dict[str, str]) -> None:
+        """Задає відповідність дублікатів їхнім канонічним файлам"""
+        self.aliases = dict(aliases)
+
+    def drop_aliases(self, paths: List[str]) -> None:
+        """Розриває зв'язки дублікатів для змінених файлів: їхній вміст більше не збігається"""
+        changed = set(paths)
+        self.aliases = {alias: canonical for alias, canonical in self.aliases.items()
+                        if alias not in changed and canonical not in changed}
+
+    def canonical(self, path: str) -> str:
+        """Шлях до файлу, під яким зберігається file_id для цього вмісту"""
+        return self.aliases.get(path, path)
+
+    def _stat(self, path: str, fresh: bool = False) -> Optional[Tuple[int, int]]:
+        """(розмір, mtime_ns) файлу на диску, а якщо його немає — з архіву медіа.
+
+        Результат запам'ятовується до forget(path) — саме його викликає media_watcher для змінених файлів.
+        """
+        if not fresh and path in self._stats:
+            return self._stats[path]
+        try:
+            st = os.stat(path)
+            result = st.st_size, st.st_mtime_ns
+        except OSError:
+            result = media_bundle.stat(path)
+        self._stats[path] = result
+        return result
+
+    def get(self, path: str) -> Optional[str]:
+        """Повертає file_id, якщо файл не змінювався з моменту завантаження"""
+        path = self.canonical(path)
+        entry = self.entries.get(path)
+        if not entry:
+            return None
+        st = self._stat(path)
+        if st is None or (entry.get('size'), entry.get('mtime')) != st:
+            return None
+        return entry.get('file_id')
+
+    def put(self, path: str, file_id: str, kind: str = 'photo') -> None:
+        """Зберігає file_id для файлу разом з його розміром та mtime"""
+        path = self.canonical(path)
+        # Файл щойно прочитано для завантаження — беремо свіжі розмір та mtime
+        st = self._stat(path, fresh=True)
+        if st is None or not file_id:
+            return
+        entry = {
+            'file_id': file_id,
+            'kind': kind,
+            'size': st[0],
+            'mtime': st[1],
+            'updated_at': datetime.now().isoformat(),
+        }
+        with self._lock:
+            self.entries[path] = entry
+            self._pending[path] = entry
+
+    def forget(self, path: str) -> None:
+        """Видаляє запис, наприклад коли Telegram більше не приймає file_id або файл змінився"""
+        path = self.canonical(path)
+        self._stats.pop(path, None)
+        with self._lock:
+            if self.entries.pop(path, None) is None:
+                return
+            self._pending[path] = None
+
+
+def media_kind(path: str) -> str:
+    """Визначає тип медіа (photo, video або document) за розширенням файлу"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PHOTO_EXTENSIONS:
+        return 'photo'
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    return 'document'
+
+
+def iter_catalog_paths(*catalogs: Any) -> List[str]:
+    """Збирає всі шляхи до файлів з вкладених словників каталогу без повторів"""
+    paths: List[str] = []
+    seen = set()
+    stack = list(reversed(catalogs))
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(reversed(list(item.values())))
+        elif isinstance(item, str) and item not in seen:
+            seen.add(item)
+            paths.append(item)
+    return paths
+
+
+def file_id_from_message(message: Message, kind: str) -> Optional[str]:
+    """Дістає file_id з повідомлення, яке повернув Telegram після відправки"""
+    if kind == 'photo':
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None)
+    return media.file_id if media else None
+
+
+# Створення глобального екземпляра
+media_cache = MediaCache(user_data.db.media_cache if user_data.db is not None else None)
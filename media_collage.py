@@ -0,0 +1,140 @@
+import io
+import os
+import math
+import hashlib
+import logging
+from typing import Dict, Optional, List, Tuple
+
+try:
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+except ImportError:  # Pillow не встановлено — колажі не будуються
+    Image = None
+
+from media_bundle import media_bundle
+from media_dedup import content_hash
+from media_derivatives import DERIVATIVES_DIR, derivative_path
+from media_index import is_url
+from media_manifest import media_manifest
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+COLLAGES_DIR = os.path.join(DERIVATIVES_DIR, 'collages')
+# Розмір однієї плитки: більшість фото тематик — вертикальні 9:16
+TILE_WIDTH = int(os.getenv('MEDIA_COLLAGE_TILE_WIDTH', '270'))
+TILE_HEIGHT = int(os.getenv('MEDIA_COLLAGE_TILE_HEIGHT', '480'))
+LABEL_HEIGHT = 44
+# TTF-шрифт з кирилицею для підписів на плитках; без нього на плитках лише номери
+FONT_PATH = os.getenv('MEDIA_COLLAGE_FONT', '')
+QUALITY = 85
+# Підпис фото в Telegram обмежений 1024 символами
+CAPTION_LIMIT = 1024
+
+# (каталог, місто, тематика) -> (шлях до готового колажу, підпис з переліком підтем)
+_collages: Dict[Tuple[str, str, str], Tuple[str, str]] = {}
+
+
+def _font(size: int):
+    if FONT_PATH:
+        try:
+            return ImageFont.truetype(FONT_PATH, size), True
+        except OSError as e:
+            logger.warning(f"[COLLAGE] Не вдалося завантажити шрифт {FONT_PATH}: {e}")
+    return ImageFont.load_default(size=size), False
+
+
+def _open(path: str):
+    """Відкриває зображення з архіву медіа, оптимізованої копії або оригіналу"""
+    view = media_bundle.view(path)
+    if view is not None:
+        return Image.open(io.BytesIO(view))
+    return Image.open(derivative_path(path))
+
+
+def _source_hash(path: str) -> str:
+    entry = media_manifest.get(path)
+    return entry['sha256'] if entry else content_hash(path)
+
+
+def _collage_name(items: List[Tuple[str, str]]) -> str:
+    """Ім'я колажу — хеш підписів, вмісту всіх фото та налаштувань: будь-яка зміна дає новий файл"""
+    digest = hashlib.sha256(f"{TILE_WIDTH}:{TILE_HEIGHT}:{FONT_PATH}:{QUALITY}".encode())
+    for label, path in items:
+        digest.update(label.encode('utf-8'))
+        digest.update(_source_hash(path).encode())
+    return digest.hexdigest() + '.jpg'
+
+
+def _render(items: List[Tuple[str, str]], dst: str) -> None:
+    columns = max(2, math.ceil(math.sqrt(len(items) * TILE_HEIGHT / TILE_WIDTH / 2)))
+    rows = math.ceil(len(items) / columns)
+    cell_height = TILE_HEIGHT + LABEL_HEIGHT
+    canvas = Image.new('RGB', (columns * TILE_WIDTH, rows * cell_height), (255, 255, 255))
+    draw = ImageDraw.Draw(canvas)
+    font, has_names = _font(LABEL_HEIGHT // 2)
+    for number, (label, path) in enumerate(items, 1):
+        x = (number - 1) % columns * TILE_WIDTH
+        y = (number - 1) // columns * cell_height
+        with _open(path) as image:
+            image.draft('RGB', (TILE_WIDTH * 2, TILE_HEIGHT * 2))
+            tile = ImageOps.fit(image.convert('RGB'), (TILE_WIDTH, TILE_HEIGHT), Image.LANCZOS)
+        canvas.paste(tile, (x, y))
+        text = f"{number}. {label}" if has_names else str(number)
+        draw.text((x + TILE_WIDTH // 2, y + TILE_HEIGHT + LABEL_HEIGHT // 2), text,
+                  fill=(0, 0, 0), font=font, anchor='mm')
+    tmp = dst + '.tmp'
+    canvas.save(tmp, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+    os.replace(tmp, dst)
+
+
+def build_collage(items: List[Tuple[str, str]]) -> Optional[str]:
+    """Створює (або знаходить готовий) колаж для списку (підпис, шлях до фото)"""
+    if Image is None or len(items) < 2:
+        return None
+    try:
+        os.makedirs(COLLAGES_DIR, exist_ok=True)
+        dst = os.path.join(COLLAGES_DIR, _collage_name(items))
+        if not os.path.exists(dst):
+            _render(items, dst)
+        return dst
+    except Exception as e:
+        logger.error(f"[COLLAGE] Помилка створення колажу: {e}")
+        return None
+
+
+def build_collages(index, theme_buttons: Dict[str, Dict[str, List[str]]]) -> int:
+    """Готує колажі для кожної тематики кожного міста; повертає кількість колажів"""
+    if Image is None:
+        logger.warning("[COLLAGE] Pillow не встановлено, колажі тематик вимкнені")
+        return 0
+    for catalog in ('theme', 'theme_vipusk'):
+        for city, themes in theme_buttons.items():
+            for theme, subthemes in themes.items():
+                items = [(subtheme, path) for subtheme in subthemes
+                         for path in [index.get(catalog, city, theme, subtheme)] if path and not is_url(path)]
+                dst = build_collage(items)
+                if dst:
+                    _collages[(catalog, city, theme)] = (dst, collage_caption([label for label, _ in items]))
+    logger.info(f"[COLLAGE] Колажі тематик готові: {len(_collages)}")
+    return len(_collages)
+
+
+def collage_for(catalog: str, city: str, theme: str) -> Optional[Tuple[str, str]]:
+    """(шлях, підпис) готового колажу тематики або None (колажі ще не побудовані чи фото замало)"""
+    return _collages.get((catalog, city, theme))
+
+
+def collage_paths() -> List[str]:
+    """Всі побудовані колажі — для попереднього завантаження в Telegram"""
+    return list(dict.fromkeys(path for path, _ in _collages.values()))
+
+
+def collage_caption(subthemes: List[str]) -> str:
+    """Нумерований перелік підтем — відповідає номерам на плитках колажу"""
+    caption = ''
+    for number, subtheme in enumerate(subthemes, 1):
+        line = f"{number}. {subtheme}\n"
+        if len(caption) + len(line) > CAPTION_LIMIT:
+            break
+        caption += line
+    return caption.rstrip()
@@ -0,0 +1,146 @@
+import os
+import hashlib
+import logging
+from typing import Dict, Optional, List, Tuple
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Pillow не встановлено — об'єднуємо лише байт-у-байт однакові файли
+    Image = None
+    ImageChops = None
+
+from media_cache import media_kind
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Максимальна відстань Геммінга між 64-бітними dHash, за якої зображення вважаються однаковими.
+# 0 — лише однакові з точністю до перестиснення (PNG та JPG однієї картинки), більше — ризик хибних збігів
+MAX_DISTANCE = int(os.getenv('MEDIA_DEDUP_MAX_DISTANCE', '0'))
+# dHash не бачить дрібного тексту (місто, ціна на афіші), тому кандидати додатково звіряються попіксельно:
+# частка помітно відмінних пікселів на зменшеній копії не має перевищувати цей поріг
+MAX_PIXEL_DIFF = float(os.getenv('MEDIA_DEDUP_MAX_PIXEL_DIFF', '0.001'))
+
+# (шлях, розмір, mtime) -> (sha256, dHash, площа в пікселях)
+_fingerprints: Dict[Tuple[str, int, int], Tuple[str, Optional[int], int]] = {}
+
+
+def content_hash(path: str) -> str:
+    """sha256 вмісту файлу"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(path: str) -> Tuple[Optional[int], int]:
+    """dHash 9x8 у відтінках сірого та площа зображення; (None, 0), якщо файл не вдалося відкрити"""
+    if Image is None:
+        return None, 0
+    try:
+        with Image.open(path) as image:
+            area = image.size[0] * image.size[1]
+            # Для JPEG декодуємо одразу в зменшеному масштабі — у рази швидше за повне декодування
+            image.draft('L', (64, 64))
+            pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning(f"[MEDIA_DEDUP] Не вдалося обчислити dHash для {path}: {e}")
+        return None, 0
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value, area
+
+
+def same_picture(first: str, second: str, max_diff: float = MAX_PIXEL_DIFF) -> bool:
+    """Попіксельно порівнює два зображення з однаковими пропорціями в масштабі 256 px"""
+    try:
+        with Image.open(first) as a, Image.open(second) as b:
+            if a.size[0] * b.size[1] != a.size[1] * b.size[0]:
+                return False
+            scale = 256 / max(a.size)
+            size = (max(1, round(a.size[0] * scale)), max(1, round(a.size[1] * scale)))
+            diff = ImageChops.difference(a.convert('L').resize(size), b.convert('L').resize(size))
+    except Exception as e:
+        logger.warning(f"[MEDIA_DEDUP] Не вдалося порівняти {first} та {second}: {e}")
+        return False
+    # Відмінності на рівні артефактів стиснення ігноруємо
+    changed = sum(1 for value in diff.getdata() if value > 32)
+    return changed <= max_diff * size[0] * size[1]
+
+
+def fingerprint(path: str) -> Optional[Tuple[str, Optional[int], int]]:
+    """(sha256, dHash, площа) файлу; результат запам'ятовується до зміни файлу"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _fingerprints:
+        dhash, area = perceptual_hash(path) if media_kind(path) == 'photo' else (None, 0)
+        _fingerprints[key] = (content_hash(path), dhash, area)
+    return _fingerprints[key]
+
+
+def build_aliases(paths: List[str], max_distance: int = MAX_DISTANCE) -> Dict[str, str]:
+    """Зводить однакові за вмістом файли до одного канонічного.
+
+    Повертає словник {шлях: канонічний шлях} лише для дублікатів. Спершу об'єднуються
+    байт-у-байт однакові файли, потім фото з однаковим (або близьким) dHash, що до того ж
+    збігаються попіксельно (див. same_picture). Канонічним стає зображення з найбільшою
+    роздільністю, а за рівної — найменший файл.
+    """
+    groups: Dict[str, List[str]] = {}
+    info: Dict[str, Tuple[Optional[int], int, int]] = {}
+    for path in paths:
+        result = fingerprint(path)
+        if result is None:
+            continue
+        sha, dhash, area = result
+        groups.setdefault(sha, []).append(path)
+        info[path] = (dhash, area, os.path.getsize(path))
+
+    # Представник кожної групи однакових байтів бере участь у порівнянні dHash
+    clusters: List[List[str]] = []
+    by_dhash: List[Tuple[int, List[str]]] = []
+    for members in groups.values():
+        dhash = info[members[0]][0]
+        if dhash is None:
+            clusters.append(members)
+            continue
+        target = next((cluster for value, cluster in by_dhash
+                       if bin(value ^ dhash).count('1') <= max_distance
+                       and same_picture(cluster[0], members[0])), None)
+        if target is None:
+            target = list(members)
+            by_dhash.append((dhash, target))
+            clusters.append(target)
+        else:
+            target.extend(members)
+
+    aliases: Dict[str, str] = {}
+    for cluster in clusters:
+        if len(cluster) < 2:
+            continue
+        canonical = min(cluster, key=lambda p: (-info[p][1], info[p][2], p))
+        for path in cluster:
+            if path != canonical:
+                aliases[path] = canonical
+
+    saved = sum(info[path][2] for path in aliases)
+    logger.info(f"[MEDIA_DEDUP] Файлів: {len(info)}, унікальних: {len(info) - len(aliases)}, "
+                f"дублікатів: {len(aliases)} ({saved / 1024 / 1024:.1f} MB не потрібно завантажувати)")
+    return aliases
+
+
+if __name__ == '__main__':
+    # Звіт про дублікати: python media_dedup.py
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    from media_index import media_index
+    for alias, canonical in sorted(build_aliases(media_index.paths()).items()):
+        print(f"{alias} -> {canonical}")
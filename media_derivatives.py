@@ -0,0 +1,147 @@
+import os
+import hashlib
+import logging
+from typing import Dict, Optional, List, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не встановлено — надсилаємо оригінали
+    Image = None
+    ImageOps = None
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Каталог з похідними зображеннями; імена файлів — хеш вмісту оригіналу та налаштувань
+DERIVATIVES_DIR = os.getenv('MEDIA_DERIVATIVES_DIR', '.media_derivatives')
+# Telegram все одно стискає фото до 2560 px по більшій стороні
+MAX_SIDE = int(os.getenv('MEDIA_DERIVATIVE_MAX_SIDE', '2560'))
+# Файли, менші за цей поріг і не більші за MAX_SIDE, надсилаються як є
+MIN_BYTES = int(os.getenv('MEDIA_DERIVATIVE_MIN_BYTES', str(1024 * 1024)))
+FORMAT = os.getenv('MEDIA_DERIVATIVE_FORMAT', 'JPEG').upper()
+QUALITY = int(os.getenv('MEDIA_DERIVATIVE_QUALITY', '85'))
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.webp']
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+# (шлях, розмір, mtime) оригіналу -> шлях до похідного файлу
+_derivatives: Dict[Tuple[str, int, int], str] = {}
+
+
+def _settings_tag() -> str:
+    return f"{FORMAT}:{MAX_SIDE}:{QUALITY}"
+
+
+def _stat_key(path: str) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_size, st.st_mtime_ns
+
+
+def _content_name(path: str) -> str:
+    """Ім'я похідного файлу: sha256 вмісту оригіналу разом з налаштуваннями перетворення"""
+    digest = hashlib.sha256(_settings_tag().encode())
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() + FORMAT_EXTENSIONS.get(FORMAT, '.jpg')
+
+
+def _transcode(src: str, dst: str) -> None:
+    """Зменшує зображення та зберігає його у прогресивному JPEG або WebP"""
+    with Image.open(src) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG не підтримує прозорість — накладаємо на білий фон
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        tmp = dst + '.tmp'
+        if FORMAT == 'WEBP':
+            image.save(tmp, 'WEBP', quality=QUALITY, method=6)
+        else:
+            image.save(tmp, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+    os.replace(tmp, dst)
+
+
+def _needs_derivative(path: str, size: int) -> bool:
+    if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+        return False
+    if size > MIN_BYTES:
+        return True
+    with Image.open(path) as image:
+        return max(image.size) > MAX_SIDE
+
+
+def build_derivative(path: str) -> Optional[str]:
+    """Створює (або знаходить готовий) похідний файл для зображення"""
+    key = _stat_key(path)
+    if Image is None or key is None:
+        return None
+    if key in _derivatives:
+        return _derivatives[key] if _derivatives[key] != path else None
+    try:
+        dst = path
+        if _needs_derivative(path, key[1]):
+            os.makedirs(DERIVATIVES_DIR, exist_ok=True)
+            dst = os.path.join(DERIVATIVES_DIR, _content_name(path))
+            if not os.path.exists(dst):
+                _transcode(path, dst)
+            if os.path.getsize(dst) >= key[1]:
+                # Перетворення не дало виграшу — залишаємо оригінал
+                dst = path
+        _derivatives[key] = dst
+        return dst if dst != path else None
+    except Exception as e:
+        logger.error(f"Помилка створення похідного зображення для {path}: {e}")
+        return None
+
+
+def build_derivatives(paths: List[str]) -> int:
+    """Готує похідні файли для всього каталогу; повертає кількість оптимізованих зображень"""
+    if Image is None:
+        logger.warning("Pillow не встановлено, оптимізація зображень вимкнена")
+        return 0
+    built = 0
+    saved = 0
+    for path in paths:
+        dst = build_derivative(path)
+        if dst:
+            built += 1
+            saved += os.path.getsize(path) - os.path.getsize(dst)
+    logger.info(f"Похідні зображення готові: {built} файлів, економія {saved / 1024 / 1024:.1f} MB")
+    return built
+
+
+def derivative_path(path: str) -> str:
+    """Повертає шлях до оптимізованої копії, якщо вона вже побудована, інакше оригінал.
+
+    Нічого не перетворює сам — лише дивиться у таблицю, заповнену build_derivatives(),
+    тож виклик безпечний всередині обробників.
+    """
+    key = _stat_key(path)
+    return _derivatives.get(key, path) if key else path
+
+
+if __name__ == '__main__':
+    # Офлайн-збірка: python media_derivatives.py
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    from config import (
+        THEME_PHOTOS, THEME_PHOTOS_VIPUSK, PAKET_PHOTOS, QWEST_PHOTOS,
+        ADDITIONAL_SERVICES_PHOTOS, FOTO_AFISHA
+    )
+    from media_cache import iter_catalog_paths
+    catalog = iter_catalog_paths(
+        THEME_PHOTOS, THEME_PHOTOS_VIPUSK, PAKET_PHOTOS, QWEST_PHOTOS,
+        ADDITIONAL_SERVICES_PHOTOS, FOTO_AFISHA
+    )
+    build_derivatives(catalog)
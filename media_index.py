@@ -0,0 +1,146 @@
+import os
+import logging
+from types import MappingProxyType
+from typing import Dict, Optional, Tuple
+from config import (
+    THEME_PHOTOS, THEME_PHOTOS_VIPUSK, PAKET_PHOTOS, QWEST_PHOTOS, ADDITIONAL_SERVICES_PHOTOS,
+    ADDITIONAL_SERVICES_WITH_SUBMENU, FOTO_AFISHA, LOCATION_PDF_FILES
+)
+from media_manifest import MediaManifest, media_manifest
+from media_bundle import media_bundle
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+IndexKey = Tuple[str, str, str, str]
+
+
+def normalize_key(value: Optional[str]) -> str:
+    """Нормалізує назву міста/категорії/позиції: без пробілів і дефісів, у верхньому регістрі"""
+    return (value or '').replace('-', '').replace(' ', '').upper()
+
+
+def is_url(path: str) -> bool:
+    """Чи є значення посиланням, а не локальним файлом"""
+    return path.startswith(('http://', 'https://'))
+
+
+class MediaIndex:
+    """Незмінний індекс медіа каталогу з config.py.
+
+    Будується один раз при старті: всі шляхи перевіряються на диску заздалегідь,
+    тож обробники отримують готовий шлях (або None) за O(1) без звернень до файлової системи.
+    """
+
+    def __init__(self, entries: Dict[IndexKey, str], options: Dict[IndexKey, Tuple[Optional[str], Optional[str]]]):
+        self._entries = MappingProxyType(entries)
+        self._options = MappingProxyType(options)
+
+    def replace(self, other: 'MediaIndex') -> None:
+        """Підміняє вміст індексу на перебудований (після зміни файлів на диску)"""
+        self._entries = other._entries
+        self._options = other._options
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, catalog: str, city: Optional[str], category: Optional[str] = None,
+            item: Optional[str] = None) -> Optional[str]:
+        """Повертає шлях до існуючого файлу (або URL) для позиції каталогу"""
+        return self._entries.get((catalog, normalize_key(city), normalize_key(category), normalize_key(item)))
+
+    def additional_option(self, city: Optional[str], service: str, option: str) -> Tuple[Optional[str], Optional[str]]:
+        """Повертає (категорію фото, шлях до фото) для опції додаткової послуги з підменю"""
+        key = ('additional_option', normalize_key(city), normalize_key(service), normalize_key(option))
+        return self._options.get(key, (None, None))
+
+    def paths(self):
+        """Всі існуючі файли індексу без повторів"""
+        return list(dict.fromkeys(self._entries.values()))
+
+
+def _resolve(path: str, missing: list, manifest: MediaManifest) -> Optional[str]:
+    # Зібраний маніфест та архів уже знають, які файли існують, — без звернень до диска
+    if path in media_bundle:
+        exists = True
+    else:
+        # Шлях, якого маніфест не бачив (додано в config.py після збирання), перевіряємо на диску
+        exists = path in manifest.entries or (
+            not (manifest.loaded and path in manifest.missing) and os.path.isfile(path)
+        )
+    if is_url(path) or exists:
+        return path
+    missing.append(path)
+    return None
+
+
+def _match_service_type(city_photos: dict, service: str) -> Optional[str]:
+    """Підбирає категорію фото для послуги за входженням назв (як раніше робилось у обробнику)"""
+    for key in city_photos:
+        if key.upper() in service.upper() or service.upper() in key.upper():
+            return key
+    if "ГЕНЕРАТОР" in service.upper() or "БУЛЬБАШОК" in service.upper():
+        return "ГЕНЕРАТОР"
+    return None
+
+
+def _match_option_photo(photo_dict: dict, option: str) -> Optional[str]:
+    """Шукає фото опції за входженням її базової назви в ключі словника фото"""
+    option_name = option.split(" - ")[0].strip()
+    base_name = option_name.split('-')[0].strip().upper()
+    for name in photo_dict:
+        if name.upper() in base_name or base_name in name.upper():
+            return photo_dict[name]
+    return None
+
+
+def build_media_index(manifest: MediaManifest = media_manifest) -> MediaIndex:
+    """Будує індекс з усіх словників медіа в config.py"""
+    entries: Dict[IndexKey, str] = {}
+    options: Dict[IndexKey, Tuple[Optional[str], Optional[str]]] = {}
+    missing: list = []
+
+    def add(catalog: str, city: str, category: str, item: str, path: str):
+        resolved = _resolve(path, missing, manifest)
+        if resolved:
+            entries[(catalog, normalize_key(city), normalize_key(category), normalize_key(item))] = resolved
+
+    for catalog, photos in (('theme', THEME_PHOTOS), ('theme_vipusk', THEME_PHOTOS_VIPUSK),
+                            ('paket', PAKET_PHOTOS), ('additional', ADDITIONAL_SERVICES_PHOTOS)):
+        for city, categories in photos.items():
+            for category, items in categories.items():
+                for item, path in items.items():
+                    add(catalog, city, category, item, path)
+    for city, items in QWEST_PHOTOS.items():
+        for item, path in items.items():
+            add('qwest', city, '', item, path)
+    for catalog, files in (('afisha', FOTO_AFISHA), ('location_pdf', LOCATION_PDF_FILES)):
+        for city, path in files.items():
+            add(catalog, city, '', '', path)
+
+    # Опції послуг з підменю: категорію та фото визначаємо один раз тут, а не на кожне повідомлення
+    for city, services in ADDITIONAL_SERVICES_WITH_SUBMENU.items():
+        city_photos = next((photos for ck, photos in ADDITIONAL_SERVICES_PHOTOS.items()
+                            if normalize_key(ck) == normalize_key(city)), None)
+        if city_photos is None:
+            continue
+        for service, service_options in services.items():
+            service_type = _match_service_type(city_photos, service)
+            for option in service_options:
+                path = None
+                if service_type and service_type in city_photos:
+                    path = _match_option_photo(city_photos[service_type], option)
+                    path = _resolve(path, missing, manifest) if path else None
+                key = ('additional_option', normalize_key(city), normalize_key(service), normalize_key(option))
+                options[key] = (service_type, path)
+                if path:
+                    entries[key] = path
+
+    for path in dict.fromkeys(missing):
+        logger.warning(f"[MEDIA_INDEX] Файл не знайдено: {path}")
+    logger.info(f"[MEDIA_INDEX] Проіндексовано {len(entries)} медіафайлів, відсутніх: {len(set(missing))}")
+    return MediaIndex(entries, options)
+
+
+# Створення глобального екземпляра
+media_index = build_media_index()
@@ -0,0 +1,194 @@
+import os
+import json
+import logging
+import mimetypes
+from datetime import datetime
+from typing import Dict, Optional, List
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не встановлено — розміри зображень у маніфест не потрапляють
+    Image = None
+
+from media_cache import media_kind
+from media_dedup import fingerprint, build_aliases
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Файл маніфесту будується командою `python media_manifest.py` під час деплою
+MANIFEST_FILE = os.getenv('MEDIA_MANIFEST_FILE', 'media_manifest.json')
+
+
+def _kind_from_mime(mime: Optional[str], path: str) -> str:
+    if mime and mime.startswith('image/'):
+        return 'photo'
+    if mime and mime.startswith('video/'):
+        return 'video'
+    return media_kind(path) if mime is None else 'document'
+
+
+def describe(path: str) -> dict:
+    """Опис одного файлу для маніфесту: розмір, розміри в пікселях, хеш та тип.
+
+    Якщо файл зник під час опису, піднімає OSError.
+    """
+    st = os.stat(path)
+    # Хеші рахуються разом з dHash і потім повторно використовуються в build_aliases
+    result = fingerprint(path)
+    if result is None:
+        # Файл прибрали між os.stat і хешуванням (наприклад, редактор зберігає через rename)
+        raise FileNotFoundError(f"файл зник під час опису: {path}")
+    sha = result[0]
+    entry = {
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'sha256': sha,
+        'mime': mimetypes.guess_type(path.lower())[0],
+    }
+    entry['kind'] = _kind_from_mime(entry['mime'], path)
+    if entry['kind'] == 'photo' and Image is not None:
+        try:
+            with Image.open(path) as image:
+                entry['width'], entry['height'] = image.size
+                entry['mime'] = Image.MIME.get(image.format, entry['mime'])
+        except Exception as e:
+            # Файл з розширенням зображення, який Pillow не відкриває, Telegram теж не прийме як фото
+            logger.warning(f"[MEDIA_MANIFEST] {path} не є зображенням, буде надіслано документом: {e}")
+            entry['kind'] = 'document'
+    return entry
+
+
+class MediaManifest:
+    """Зібраний заздалегідь опис усіх медіафайлів каталогу.
+
+    Завантажується при старті одним читанням файлу, тож перевірка наявності файлу
+    та вибір способу відправки не потребують звернень до файлової системи.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, dict]] = None, missing: Optional[List[str]] = None,
+                 aliases: Optional[Dict[str, str]] = None, built_at: Optional[str] = None):
+        self.entries = entries or {}
+        self.missing = missing or []
+        self.aliases = aliases or {}
+        self.built_at = built_at
+
+    @property
+    def loaded(self) -> bool:
+        return self.built_at is not None
+
+    @classmethod
+    def load(cls, filename: str = MANIFEST_FILE) -> 'MediaManifest':
+        """Завантажує маніфест; якщо файлу немає — повертає порожній"""
+        if not os.path.exists(filename):
+            logger.info(f"[MEDIA_MANIFEST] {filename} не знайдено, медіа перевірятимуться на диску")
+            return cls()
+        try:
+            with open(filename, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            manifest = cls(data['entries'], data.get('missing'), data.get('aliases'), data['built_at'])
+            logger.info(f"[MEDIA_MANIFEST] Завантажено {len(manifest.entries)} файлів (зібрано {manifest.built_at})")
+            return manifest
+        except (json.JSONDecodeError, KeyError, OSError) as e:
+            logger.error(f"[MEDIA_MANIFEST] Помилка читання {filename}: {e}")
+            return cls()
+
+    def save(self, filename: str = MANIFEST_FILE) -> None:
+        data = {
+            'built_at': self.built_at,
+            'entries': self.entries,
+            'missing': self.missing,
+            'aliases': self.aliases,
+        }
+        tmp = filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, filename)
+
+    def replace(self, other: 'MediaManifest') -> None:
+        """Підміняє вміст маніфесту на свіжозібраний, зберігаючи сам об'єкт для всіх, хто його тримає"""
+        self.entries = other.entries
+        self.missing = other.missing
+        self.aliases = other.aliases
+        self.built_at = other.built_at
+
+    def get(self, path: str) -> Optional[dict]:
+        return self.entries.get(path)
+
+    def kind(self, path: str) -> str:
+        """Тип медіа з маніфесту; для файлів поза маніфестом — за розширенням"""
+        entry = self.entries.get(path)
+        return entry['kind'] if entry else media_kind(path)
+
+    def stale_paths(self, paths: Optional[List[str]] = None) -> List[str]:
+        """Файли, що зникли, змінилися або з'явилися після збирання маніфесту.
+
+        paths — поточні шляхи каталогу: ті з них, яких маніфест ще не бачив, теж вважаються застарілими.
+        """
+        stale = []
+        for path, entry in self.entries.items():
+            try:
+                st = os.stat(path)
+                if (st.st_size, st.st_mtime_ns) != (entry['size'], entry.get('mtime', st.st_mtime_ns)):
+                    stale.append(path)
+            except OSError:
+                stale.append(path)
+        # Файли, яких не було при збиранні, але які вже з'явилися на диску
+        stale.extend(path for path in self.missing if os.path.isfile(path))
+        known = set(self.entries).union(self.missing)
+        stale.extend(path for path in dict.fromkeys(paths or [])
+                     if path not in known and not path.startswith(('http://', 'https://')))
+        return stale
+
+def build_manifest(paths: List[str]) -> MediaManifest:
+    """Описує всі локальні файли каталогу; відсутні файли потрапляють у звіт, а не в маніфест"""
+    entries: Dict[str, dict] = {}
+    missing: List[str] = []
+    for path in dict.fromkeys(paths):
+        if path.startswith(('http://', 'https://')):
+            continue
+        if not os.path.isfile(path):
+            missing.append(path)
+            continue
+        try:
+            entries[path] = describe(path)
+        except OSError:
+            # Один зниклий файл не зупиняє збирання всього маніфесту
+            missing.append(path)
+    for path in missing:
+        logger.warning(f"[MEDIA_MANIFEST] Файл не знайдено: {path}")
+    manifest = MediaManifest(entries, missing, build_aliases(list(entries)), datetime.now().isoformat())
+    total = sum(entry['size'] for entry in entries.values())
+    logger.info(f"[MEDIA_MANIFEST] Описано {len(entries)} файлів ({total / 1024 / 1024:.1f} MB), "
+                f"відсутніх: {len(missing)}")
+    return manifest
+
+
+def catalog_paths() -> List[str]:
+    """Всі шляхи до медіа, на які посилається config.py"""
+    from config import (
+        THEME_PHOTOS, THEME_PHOTOS_VIPUSK, PAKET_PHOTOS, QWEST_PHOTOS,
+        ADDITIONAL_SERVICES_PHOTOS, FOTO_AFISHA, LOCATION_PDF_FILES
+    )
+    from media_cache import iter_catalog_paths
+    return iter_catalog_paths(
+        THEME_PHOTOS, THEME_PHOTOS_VIPUSK, PAKET_PHOTOS, QWEST_PHOTOS,
+        ADDITIONAL_SERVICES_PHOTOS, FOTO_AFISHA, LOCATION_PDF_FILES
+    )
+
+
+# Створення глобального екземпляра
+media_manifest = MediaManifest.load()
+
+
+if __name__ == '__main__':
+    # Збірка маніфесту: python media_manifest.py
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    result = build_manifest(catalog_paths())
+    result.save()
+    print(f"Маніфест записано у {MANIFEST_FILE}: {len(result.entries)} файлів, відсутніх: {len(result.missing)}")
+    for missing_path in result.missing:
+        print(f"  відсутній: {missing_path}")
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from config import MEDIA_MEMORY_CACHE_MB
+from media_bundle import MediaBundle, media_bundle
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+class MediaReader:
+    """Читає медіафайли в пулі потоків і тримає популярні з них у пам'яті.
+
+    Кеш обмежений сумарним розміром у байтах і витісняє найдавніше використані файли.
+    Файли, більші за чверть ліміту, не кешуються, щоб один великий файл не витіснив решту.
+    Файли з архіву (media_bundle) беруться з відображеної пам'яті й у кеш не потрапляють.
+    """
+
+    def __init__(self, max_bytes: int, bundle: Optional[MediaBundle] = None):
+        self.max_bytes = max_bytes
+        self.bundle = bundle
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def view(self, path: str) -> Optional[memoryview]:
+        """Вміст файлу з архіву без копіювання або None, якщо файлу в архіві немає"""
+        return self.bundle.view(path) if self.bundle is not None else None
+
+    async def read(self, path: str, cache: bool = True) -> bytes:
+        """Повертає вміст файлу, не блокуючи цикл подій"""
+        view = self.view(path)
+        if view is not None:
+            # python-telegram-bot приймає лише bytes, тож одна копія на завантаження неминуча;
+            # робимо її в потоці, бо вона ж спричиняє підкачку сторінок з диска
+            self.hits += 1
+            return await asyncio.to_thread(bytes, view)
+
+        data = self._cache.get(path)
+        if data is not None:
+            self._cache.move_to_end(path)
+            self.hits += 1
+            return data
+        self.misses += 1
+
+        # Кілька користувачів одночасно відкрили ту саму тему — читаємо файл лише раз
+        future = self._inflight.get(path)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(_read_file, path))
+            self._inflight[path] = future
+            future.add_done_callback(lambda _: self._inflight.pop(path, None))
+        data = await asyncio.shield(future)
+        if cache:
+            self._store(path, data)
+        return data
+
+    def _store(self, path: str, data: bytes) -> None:
+        if path in self._cache or len(data) > self.max_bytes // 4:
+            return
+        self._cache[path] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and self._cache:
+            _, evicted = self._cache.popitem(last=False)
+            self.size -= len(evicted)
+
+    def invalidate(self, path: str) -> None:
+        """Прибирає файл з кешу, наприклад після його заміни на диску"""
+        data = self._cache.pop(path, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self._cache),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# Створення глобального екземпляра
+media_reader = MediaReader(MEDIA_MEMORY_CACHE_MB * 1024 * 1024, media_bundle)
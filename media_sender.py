@@ -0,0 +1,236 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional, Any, List, Tuple
+from telegram import Bot, Message, InputMediaPhoto
+from telegram.error import BadRequest, RetryAfter
+
+from config import MEDIA_MAX_CONCURRENT_UPLOADS
+from media_cache import MediaCache, media_cache, file_id_from_message
+from media_derivatives import derivative_path
+from media_video import video_info
+from media_index import MediaIndex, media_index, is_url
+from media_manifest import MediaManifest, media_manifest
+from media_reader import MediaReader, media_reader
+from media_server import MediaServer, media_server
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Telegram приймає в одному альбомі від 2 до 10 файлів
+MEDIA_GROUP_LIMIT = 10
+
+# Методи відправки відповіді для кожного типу медіа
+REPLY_METHODS = {
+    'photo': 'reply_photo',
+    'video': 'reply_video',
+    'document': 'reply_document',
+}
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        retry_after = retry_after.total_seconds()
+    return retry_after
+
+
+class MediaSender:
+    """Єдина точка відправки медіа з каталогу.
+
+    За ключем каталогу знаходить файл в індексі, обирає метод відправки за типом файлу,
+    повторно використовує file_id з кешу, а справжні завантаження обмежує спільним семафором.
+    """
+
+    def __init__(self, index: MediaIndex, manifest: MediaManifest, cache: MediaCache, reader: MediaReader,
+                 server: MediaServer, max_uploads: int):
+        self.index = index
+        self.manifest = manifest
+        self.cache = cache
+        self.reader = reader
+        self.server = server
+        self.upload_semaphore = asyncio.Semaphore(max_uploads)
+
+    def upload_path(self, path: str, kind: str) -> str:
+        """Файл, який реально відправляється в Telegram: для фото — оптимізована копія, якщо є.
+
+        В архів медіа оптимізовані копії пакуються під шляхом оригіналу.
+        """
+        if kind not in ('photo', 'video') or self.reader.view(path) is not None:
+            return path
+        if kind == 'video':
+            video = video_info(path)
+            return video['path'] if video else path
+        return derivative_path(path)
+
+    async def upload_kwargs(self, path: str, kind: str) -> dict:
+        """Параметри завантаження файлу: ім'я, а для відео — тривалість, розміри та мініатюра"""
+        kwargs = {'filename': os.path.basename(path)}
+        video = video_info(path) if kind == 'video' else None
+        if video:
+            kwargs.update(
+                filename=os.path.splitext(kwargs['filename'])[0] + '.mp4',
+                duration=video['duration'],
+                width=video['width'],
+                height=video['height'],
+                thumbnail=await self.reader.read(video['thumbnail']),
+            )
+        return kwargs
+
+    async def send(self, message: Message, catalog: str, city: Optional[str], category: Optional[str] = None,
+                   item: Optional[str] = None, **kwargs: Any) -> Optional[Message]:
+        """Відправляє медіа позиції каталогу; повертає None, якщо файлу для неї немає"""
+        path = self.index.get(catalog, city, category, item)
+        if not path:
+            return None
+        return await self.send_path(message, path, **kwargs)
+
+    async def send_path(self, message: Message, path: str, kind: Optional[str] = None, **kwargs: Any) -> Message:
+        """Відповідає медіафайлом, використовуючи file_id з кешу замість повторного завантаження"""
+        kind = kind or self.manifest.kind(path)
+        send = getattr(message, REPLY_METHODS[kind])
+        if kind == 'video':
+            # Відтворення починається до повного завантаження (MP4 перекодовано з +faststart)
+            kwargs.setdefault('supports_streaming', True)
+        if is_url(path):
+            return await send(path, **kwargs)
+        # Дублікат завантажуємо (і кешуємо) як його канонічний файл
+        path = self.cache.canonical(path)
+
+        file_id = self.cache.get(path)
+        if file_id:
+            try:
+                return await send(file_id, **kwargs)
+            except BadRequest as e:
+                logger.warning(f"file_id для {path} більше не дійсний: {e}")
+                self.cache.forget(path)
+
+        # Telegram може сам забрати файл з нашого сервера — тоді вихідний канал бота не зайнятий
+        url = self.server.url_for(self.upload_path(path, kind), kind)
+        if url:
+            try:
+                sent = await send(url, **kwargs)
+                self.cache.put(path, file_id_from_message(sent, kind), kind)
+                return sent
+            except BadRequest as e:
+                logger.warning(f"Telegram не зміг забрати {path} за URL, надсилаємо файл: {e}")
+
+        # Файл ще не завантажений у Telegram: читаємо його в потоці (або беремо з пам'яті)
+        for key, value in (await self.upload_kwargs(path, kind)).items():
+            kwargs.setdefault(key, value)
+        async with self.upload_semaphore:
+            data = await self.reader.read(self.upload_path(path, kind))
+            sent = await send(data, **kwargs)
+        self.cache.put(path, file_id_from_message(sent, kind), kind)
+        return sent
+
+    async def send_album(self, message: Message, catalog: str, city: Optional[str], category: Optional[str],
+                         items: List[str], max_albums: Optional[int] = None) -> int:
+        """Відправляє фото кількох позицій каталогу альбомами по 10 з назвою позиції в підписі.
+
+        Повертає кількість відправлених фото; позиції без фото (або не фото) пропускаються,
+        а max_albums обмежує кількість альбомів (решта позицій не надсилається).
+        """
+        photos = [(item, self.cache.canonical(path)) for item in items
+                  for path in [self.index.get(catalog, city, category, item)]
+                  if path and self.manifest.kind(path) == 'photo']
+        if max_albums is not None:
+            photos = photos[:max_albums * MEDIA_GROUP_LIMIT]
+        for start in range(0, len(photos), MEDIA_GROUP_LIMIT):
+            chunk = photos[start:start + MEDIA_GROUP_LIMIT]
+            if len(chunk) == 1:
+                item, path = chunk[0]
+                await self.send_path(message, path, 'photo', caption=item)
+                continue
+            try:
+                await self._send_group(message, chunk)
+            except BadRequest as e:
+                # Застарів file_id або Telegram не забрав файл за URL — не відомо, який саме,
+                # тож завантажуємо весь альбом заново
+                logger.warning(f"Альбом не відправлено через file_id з кешу або URL, завантажуємо заново: {e}")
+                for _, path in chunk:
+                    self.cache.forget(path)
+                await self._send_group(message, chunk, use_urls=False)
+        return len(photos)
+
+    async def _send_group(self, message: Message, chunk: List[Tuple[str, str]], use_urls: bool = True) -> None:
+        file_ids = [self.cache.get(path) if not is_url(path) else path for _, path in chunk]
+        sources = [file_id or (use_urls and self.server.url_for(self.upload_path(path, 'photo'), 'photo'))
+                   for (_, path), file_id in zip(chunk, file_ids)]
+        uploads = [path for (_, path), source in zip(chunk, sources) if not source]
+        if not uploads:
+            sent = await message.reply_media_group(
+                [InputMediaPhoto(source, caption=item) for (item, _), source in zip(chunk, sources)]
+            )
+        else:
+            async with self.upload_semaphore:
+                data = await asyncio.gather(*(self.reader.read(self.upload_path(path, 'photo')) for path in uploads))
+                data = iter(data)
+                media = [InputMediaPhoto(source or next(data), caption=item, filename=os.path.basename(path))
+                         for (item, path), source in zip(chunk, sources)]
+                sent = await message.reply_media_group(media)
+        for (_, path), file_id, reply in zip(chunk, file_ids, sent):
+            if not file_id:
+                self.cache.put(path, file_id_from_message(reply, 'photo'), 'photo')
+
+    async def prewarm(self, bot: Bot, chat_id: int, paths: List[str],
+                      concurrency: int = 3, interval: float = 1.0) -> None:
+        """Завантажує весь каталог у службовий чат, щоб заповнити кеш file_id ще до першого клієнта"""
+        canonical = dict.fromkeys(self.cache.canonical(path) for path in paths)
+        pending = [path for path in canonical if (self.reader.view(path) is not None or os.path.isfile(path))
+                   and not self.cache.get(path)]
+        total = len(pending)
+        logger.info(f"[PREWARM] До завантаження {total} файлів, пропущено {len(paths) - total}")
+        if not total:
+            return
+
+        workers = asyncio.Semaphore(concurrency)
+        slot_lock = asyncio.Lock()
+        next_slot = 0.0
+        done = failed = 0
+
+        async def wait_for_slot():
+            # Telegram обмежує частоту повідомлень в один чат, тож розносимо відправки в часі
+            nonlocal next_slot
+            async with slot_lock:
+                now = time.monotonic()
+                delay = next_slot - now
+                next_slot = max(now, next_slot) + interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        async def upload(path: str):
+            nonlocal done, failed
+            kind = self.manifest.kind(path)
+            send = getattr(bot, f"send_{kind}")
+            async with workers:
+                while True:
+                    await wait_for_slot()
+                    try:
+                        async with self.upload_semaphore:
+                            data = await self.reader.read(self.upload_path(path, kind), cache=False)
+                            extra = await self.upload_kwargs(path, kind)
+                            if kind == 'video':
+                                extra['supports_streaming'] = True
+                            sent = await send(chat_id, data, disable_notification=True, **extra)
+                        self.cache.put(path, file_id_from_message(sent, kind), kind)
+                        done += 1
+                        break
+                    except RetryAfter as e:
+                        logger.warning(f"[PREWARM] Ліміт Telegram, чекаємо {_retry_seconds(e)} с")
+                        await asyncio.sleep(_retry_seconds(e))
+                    except Exception as e:
+                        logger.error(f"[PREWARM] Не вдалося завантажити {path}: {e}")
+                        failed += 1
+                        break
+            if (done + failed) % 10 == 0 or done + failed == total:
+                logger.info(f"[PREWARM] Прогрес: {done + failed}/{total} (помилок: {failed})")
+
+        await asyncio.gather(*(upload(path) for path in pending))
+        logger.info(f"[PREWARM] Завершено: завантажено {done}, помилок {failed}")
+
+
+# Створення глобального екземпляра
+media_sender = MediaSender(media_index, media_manifest, media_cache, media_reader, media_server,
+                           MEDIA_MAX_CONCURRENT_UPLOADS)
@@ -0,0 +1,133 @@
+import os
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from typing import Dict, Optional, Union
+from urllib.parse import unquote
+
+from config import MEDIA_PUBLIC_URL, MEDIA_SERVER_HOST, MEDIA_SERVER_PORT
+from media_reader import MediaReader, media_reader
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Ліміти Bot API на завантаження файлів за URL
+URL_SIZE_LIMITS = {
+    'photo': 5 * 1024 * 1024,
+    'video': 20 * 1024 * 1024,
+    'document': 20 * 1024 * 1024,
+}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+class MediaServer:
+    """Мінімальний асинхронний HTTP-сервер для роздачі медіа Telegram-у.
+
+    Роздає лише ті файли, для яких бот сам видав URL через url_for(): адреса — це хеш
+    шляху, розміру та mtime, тож довільні файли з диска отримати неможливо, а після
+    заміни файлу змінюється і URL (Telegram не віддасть стару копію зі свого кешу).
+    """
+
+    def __init__(self, public_url: str, reader: MediaReader, host: str = '0.0.0.0', port: int = 8080):
+        self.public_url = public_url
+        self.reader = reader
+        self.host = host
+        self.port = port
+        self.served = 0
+        self._files: Dict[str, str] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.public_url)
+
+    def url_for(self, path: str, kind: str) -> Optional[str]:
+        """URL файлу для Telegram або None, якщо режим вимкнено чи файл завеликий для завантаження за URL"""
+        if not self.enabled:
+            return None
+        view = self.reader.view(path)
+        if view is not None:
+            size, mtime = len(view), self.reader.bundle.stat(path)[1]
+        else:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            size, mtime = st.st_size, st.st_mtime_ns
+        if size > URL_SIZE_LIMITS.get(kind, 0):
+            return None
+        token = hashlib.sha1(f"{path}:{size}:{mtime}".encode()).hexdigest()[:20]
+        name = token + os.path.splitext(path)[1].lower()
+        self._files[name] = path
+        return f"{self.public_url}/{name}"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"[MEDIA_SERVER] Роздача медіа на {self.host}:{self.port}, публічна адреса {self.public_url}")
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        logger.info(f"[MEDIA_SERVER] Зупинено, віддано файлів: {self.served}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=10)
+            # Заголовки запиту не потрібні, але їх треба дочитати до порожнього рядка
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) != 3:
+                await self._respond(writer, 400)
+                return
+            method, target, _ = parts
+            if method not in ('GET', 'HEAD'):
+                await self._respond(writer, 405)
+                return
+            path = self._files.get(unquote(target.split('?', 1)[0]).lstrip('/'))
+            if path is None:
+                await self._respond(writer, 404)
+                return
+            try:
+                # Файл з архіву пишеться в сокет прямо з відображеної пам'яті, решта — з кешу читача
+                data = self.reader.view(path)
+                if data is None:
+                    data = await self.reader.read(path)
+            except OSError:
+                await self._respond(writer, 404)
+                return
+            content_type = mimetypes.guess_type(path.lower())[0] or 'application/octet-stream'
+            await self._respond(writer, 200, data, content_type, head=method == 'HEAD')
+            self.served += 1
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"[MEDIA_SERVER] Обрив з'єднання: {e}")
+        except Exception as e:
+            logger.error(f"[MEDIA_SERVER] Помилка обробки запиту: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, body: Union[bytes, memoryview] = b'',
+                       content_type: str = 'text/plain', head: bool = False) -> None:
+        headers = (
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        if status == 200:
+            # Вміст за URL ніколи не змінюється — адреса залежить від розміру та mtime файлу
+            headers += "Cache-Control: public, max-age=31536000, immutable\r\n"
+        headers += "Connection: close\r\n\r\n"
+        writer.write(headers.encode('latin-1'))
+        if not head:
+            writer.write(body)
+        await writer.drain()
+
+
+# Створення глобального екземпляра
+media_server = MediaServer(MEDIA_PUBLIC_URL, media_reader, MEDIA_SERVER_HOST, MEDIA_SERVER_PORT)
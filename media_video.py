@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import logging
+import subprocess
+from typing import Dict, Optional, List, Tuple
+
+from media_bundle import media_bundle
+from media_cache import media_kind
+from media_dedup import content_hash
+from media_derivatives import DERIVATIVES_DIR
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+FFMPEG = shutil.which('ffmpeg')
+FFPROBE = shutil.which('ffprobe')
+
+VIDEOS_DIR = os.path.join(DERIVATIVES_DIR, 'videos')
+# Більша сторона кадру після перекодування
+MAX_SIDE = int(os.getenv('MEDIA_VIDEO_MAX_SIDE', '1280'))
+# Ліміт розміру файлу: 20 MB — це ще й межа для завантаження за URL (див. media_server)
+MAX_BYTES = int(os.getenv('MEDIA_VIDEO_MAX_MB', '20')) * 1024 * 1024
+CRF = int(os.getenv('MEDIA_VIDEO_CRF', '26'))
+AUDIO_BITRATE = 128_000
+# Telegram приймає мініатюру не більше 320 px по більшій стороні
+THUMBNAIL_SIDE = 320
+
+# (шлях, розмір, mtime) оригіналу -> опис перекодованого відео
+_videos: Dict[Tuple[str, int, int], dict] = {}
+
+
+def _stat_key(path: str) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_size, st.st_mtime_ns
+
+
+def _run(args: List[str]) -> subprocess.CompletedProcess:
+    return subprocess.run(args, capture_output=True, check=True, timeout=600)
+
+
+def probe(path: str) -> Optional[dict]:
+    """Тривалість (секунди) та розміри кадру відео через ffprobe"""
+    if FFPROBE is None:
+        return None
+    try:
+        result = _run([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                       '-show_entries', 'stream=width,height:format=duration', '-of', 'json', path])
+        data = json.loads(result.stdout)
+        stream = data['streams'][0]
+        return {
+            'duration': round(float(data['format']['duration'])),
+            'width': int(stream['width']),
+            'height': int(stream['height']),
+        }
+    except (subprocess.SubprocessError, OSError, KeyError, IndexError, ValueError) as e:
+        logger.warning(f"[VIDEO] Не вдалося прочитати параметри {path}: {e}")
+        return None
+
+
+def _transcode(src: str, dst: str, duration: int) -> None:
+    """H.264/AAC MP4 з moov-атомом на початку, щоб Telegram почав відтворення до повного завантаження"""
+    scale = (f"scale=w='min({MAX_SIDE},iw)':h='min({MAX_SIDE},ih)'"
+             f":force_original_aspect_ratio=decrease:force_divisible_by=2")
+    base = [FFMPEG, '-y', '-v', 'error', '-i', src, '-vf', scale, '-c:v', 'libx264', '-preset', 'medium',
+            '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', str(AUDIO_BITRATE), '-movflags', '+faststart']
+    tmp = dst + '.tmp.mp4'
+    _run(base + ['-crf', str(CRF), tmp])
+    if os.path.getsize(tmp) > MAX_BYTES and duration:
+        # Якість за CRF не вмістилася в ліміт — кодуємо з бітрейтом, розрахованим під розмір
+        bitrate = max(100_000, int(MAX_BYTES * 8 * 0.95 / duration) - AUDIO_BITRATE)
+        _run(base + ['-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(bitrate * 2), tmp])
+    os.replace(tmp, dst)
+
+
+def _thumbnail(src: str, dst: str, duration: int) -> None:
+    tmp = dst + '.tmp.jpg'
+    scale = f"scale=w='min({THUMBNAIL_SIDE},iw)':h='min({THUMBNAIL_SIDE},ih)':force_original_aspect_ratio=decrease"
+    _run([FFMPEG, '-y', '-v', 'error', '-ss', str(min(1, duration / 2)), '-i', src, '-frames:v', '1',
+          '-vf', scale, '-q:v', '5', tmp])
+    os.replace(tmp, dst)
+
+
+def build_video(path: str) -> Optional[dict]:
+    """Перекодовує відео (або знаходить готове); повертає шлях, мініатюру, тривалість і розміри"""
+    key = _stat_key(path)
+    if FFMPEG is None or FFPROBE is None or key is None or media_kind(path) != 'video':
+        return None
+    if key in _videos:
+        return _videos[key]
+    try:
+        os.makedirs(VIDEOS_DIR, exist_ok=True)
+        name = content_hash(path)[:32] + f"-{MAX_SIDE}-{CRF}-{MAX_BYTES}"
+        dst = os.path.join(VIDEOS_DIR, name + '.mp4')
+        thumbnail = os.path.join(VIDEOS_DIR, name + '.jpg')
+        source = probe(path)
+        if source is None:
+            return None
+        if not os.path.exists(dst):
+            _transcode(path, dst, source['duration'])
+        info = probe(dst) or source
+        if not os.path.exists(thumbnail):
+            _thumbnail(dst, thumbnail, info['duration'])
+        video = dict(info, path=dst, thumbnail=thumbnail)
+        _videos[key] = video
+        logger.info(f"[VIDEO] {path}: {key[1] / 1024 / 1024:.1f} MB -> {os.path.getsize(dst) / 1024 / 1024:.1f} MB, "
+                    f"{info['width']}x{info['height']}, {info['duration']} с")
+        return video
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.error(f"[VIDEO] Помилка перекодування {path}: {e}")
+        return None
+
+
+def build_videos(paths: List[str]) -> int:
+    """Готує перекодовані відео для каталогу; повертає їх кількість"""
+    videos = [path for path in paths if media_kind(path) == 'video']
+    if not videos:
+        return 0
+    if FFMPEG is None or FFPROBE is None:
+        logger.warning("[VIDEO] ffmpeg/ffprobe не знайдено, відео надсилатимуться як є")
+        return 0
+    return sum(1 for path in videos if build_video(path))
+
+
+def video_info(path: str) -> Optional[dict]:
+    """Опис готового перекодованого відео або None; нічого не перекодовує сам.
+
+    Якщо відео прийшло з архіву медіа (build_videos() при старті не запускався), опис береться з нього.
+    """
+    key = _stat_key(path)
+    video = _videos.get(key) if key else None
+    return video or media_bundle.video_info(path)
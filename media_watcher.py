@@ -0,0 +1,105 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    from watchfiles import awatch
+except ImportError:  # watchfiles не встановлено — періодично перевіряємо файли самі
+    awatch = None
+
+from media_bundle import media_bundle
+from media_cache import media_cache
+from media_derivatives import build_derivative
+from media_video import build_video
+from media_index import media_index, build_media_index
+from media_manifest import media_manifest, describe
+from media_reader import media_reader
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Інтервал перевірки файлів (секунди), коли watchfiles/inotify недоступні
+WATCH_INTERVAL = float(os.getenv('MEDIA_WATCH_INTERVAL', '5'))
+
+
+def _snapshot(paths: List[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+    snapshot = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            snapshot[path] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+
+def _watch_roots(paths: List[str]) -> List[str]:
+    """Найближчі існуючі каталоги над файлами каталогу (файлу може ще не бути)"""
+    roots = set()
+    for path in paths:
+        directory = os.path.dirname(path) or '.'
+        while not os.path.isdir(directory) and os.path.dirname(directory) != directory:
+            directory = os.path.dirname(directory) or '.'
+        roots.add(directory)
+    # Вкладені каталоги вже покриває батьківський
+    return [root for root in roots
+            if not any(root != other and root.startswith(other.rstrip('/') + '/') for other in roots)]
+
+
+async def watch_media(paths: List[str], on_change: Callable[[Set[str]], Awaitable[None]]) -> None:
+    """Стежить за файлами каталогу й викликає on_change з множиною змінених, доданих або видалених шляхів"""
+    watched = set(paths)
+    if awatch is not None:
+        roots = _watch_roots(paths)
+        logger.info(f"[MEDIA_WATCH] Стежимо через inotify за {len(roots)} каталогами")
+        cwd = os.getcwd()
+        async for changes in awatch(*roots):
+            changed = {os.path.relpath(path, cwd) for _, path in changes} & watched
+            if changed:
+                await on_change(changed)
+        return
+
+    logger.info(f"[MEDIA_WATCH] watchfiles не встановлено, перевіряємо файли кожні {WATCH_INTERVAL} с")
+    previous = await asyncio.to_thread(_snapshot, paths)
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        current = await asyncio.to_thread(_snapshot, paths)
+        changed = {path for path in paths if current[path] != previous[path]}
+        previous = current
+        if changed:
+            await on_change(changed)
+
+
+def _refresh_derived(changed: Set[str]) -> None:
+    """Важка частина оновлення (хеші, перекодування, індекс) — виконується в потоці"""
+    for path in changed:
+        try:
+            # Файл може зникнути й після перевірки — тоді він просто вважається видаленим
+            entry = describe(path) if os.path.isfile(path) else None
+        except OSError:
+            entry = None
+        if entry is None:
+            media_manifest.entries.pop(path, None)
+            continue
+        media_manifest.entries[path] = entry
+        build_derivative(path)
+        build_video(path)
+    media_index.replace(build_media_index(media_manifest))
+
+
+async def invalidate_media(changed: Set[str]) -> List[str]:
+    """Скидає кеші лише для змінених файлів; повертає ті з них, що існують (для повторного прогріву)"""
+    logger.info(f"[MEDIA_WATCH] Змінено файлів: {len(changed)}: {', '.join(sorted(changed)[:5])}")
+    paths = list(changed)
+    # Старі байти в архіві та пам'яті більше не відповідають файлу; оптимізовані копії
+    # прив'язані до розміру та mtime, тож стара копія сама перестає знаходитись
+    media_bundle.discard(paths)
+    for path in paths:
+        media_reader.invalidate(path)
+    # Дублікатом змінений файл бути вже не може — інакше він отримав би чужий file_id
+    media_cache.drop_aliases(paths)
+    for path in paths:
+        media_cache.forget(path)
+    await asyncio.to_thread(_refresh_derived, changed)
+    return [path for path in paths if path in media_manifest.entries or os.path.isfile(path)]
@@ -1,13 +1,22 @@
 import os
-import json
+import copy
+import heapq
+import asyncio
+import functools
 import logging
-from typing import Dict, Optional, Any, Union
-from pymongo import MongoClient
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any, Iterator, AsyncIterator, List, Tuple, Union
+from pymongo import MongoClient, UpdateOne, uri_parser
 from pymongo.database import Database
 from pymongo.collection import Collection
-from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+from pymongo.errors import BulkWriteError, PyMongoError, ServerSelectionTimeoutError
+from pymongo.monitoring import ServerHeartbeatListener
 from datetime import datetime
 import certifi
+from user_journal import UserJournal
 
 # Налаштування логування
 logging.basicConfig(
@@ -16,55 +25,264 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Як часто драйвер перевіряє сервери MongoDB у фоні (мілісекунди)
+MONGODB_HEARTBEAT_MS = int(os.getenv('MONGODB_HEARTBEAT_MS', '5000'))
+MONGODB_DATABASE = os.getenv('MONGODB_DATABASE', 'confetti')
+# Пул з'єднань для запитів з обробників (get_user, add_user): скільки запитів іде паралельно
+MONGODB_MAX_POOL_SIZE = int(os.getenv('MONGODB_MAX_POOL_SIZE', '10'))
+# Скільки з'єднань драйвер тримає відкритими заздалегідь, щоб перші запити не чекали на підключення
+MONGODB_MIN_POOL_SIZE = int(os.getenv('MONGODB_MIN_POOL_SIZE', '2'))
+# Скільки запит чекає на вільне з'єднання, перш ніж завершитися помилкою
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+# Окремий клієнт для масових операцій (bulk_write, перебір користувачів), щоб вони не займали
+# з'єднання обробників; 0 — використовувати основний клієнт
+MONGODB_BULK_POOL_SIZE = int(os.getenv('MONGODB_BULK_POOL_SIZE', '2'))
+# Стани розмов накопичуються в пам'яті й записуються одним bulk_write раз на інтервал
+# (мілісекунди) або коли змінилось стільки користувачів; інтервал — межа втрати даних при збої
+STATE_FLUSH_INTERVAL_MS = int(os.getenv('STATE_FLUSH_INTERVAL_MS', '1000'))
+STATE_FLUSH_MAX_USERS = int(os.getenv('STATE_FLUSH_MAX_USERS', '50'))
+# Перевірка версії стану: дельта застосовується лише до тієї версії документа, яку бот записав
+# сам; якщо документ змінив хтось інший (наприклад, друга копія бота під час деплою),
+# конфлікт логується і стан перезаписується повністю
+STATE_VERSION_CHECK = os.getenv('STATE_VERSION_CHECK', '1') == '1'
+# Скільки користувачів записується одним bulk_write у save_data()
+SAVE_BATCH_SIZE = int(os.getenv('USERS_SAVE_BATCH_SIZE', '500'))
+# Сховище користувачів: 'mongo' (MongoDB з локальним журналом на випадок збою) або 'sqlite'
+USER_STORAGE = os.getenv('USER_STORAGE', 'mongo')
+# Кеш get_user: скільки користувачів тримати в пам'яті та скільки секунд запис вважається свіжим
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+# Скільки користувачів читається за один запит при переборі всієї бази (експорт, розсилка)
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '500'))
+SQLITE_FILE = os.getenv('USER_SQLITE_FILE', 'users.sqlite3')
+# Поля, які обробники беруть з поточного оновлення Telegram, а не з попереднього документа.
+# Якщо зміну зроблено, коли документа не було видно (MongoDB недоступна), лише вони пишуться
+# через $set; решта (visits, status, device_info...) обчислена з порожнього документа
+# і потрапляє в базу тільки для нового користувача ($setOnInsert)
+FRESH_USER_FIELDS = ('_id', 'user_id', 'username', 'first_name', 'last_name', 'language_code', 'is_bot',
+                     'last_update', 'full_user_obj', 'chat_id', 'type', 'phone_number')
+
+
+class MongoHealth(ServerHeartbeatListener):
+    """Стан підключення до MongoDB за фоновими heartbeat-ами pymongo.
+
+    Драйвер сам опитує кожен сервер раз на heartbeatFrequencyMS (і позачергово після
+    мережевої помилки); слухач лише запам'ятовує результат, тож перевірка перед операцією —
+    це читання прапорця, а не окремий запит до сервера.
+    """
+
+    def __init__(self):
+        self.connected = False
+        self._servers: Dict[Any, bool] = {}
+
+    def _update(self, address, ok: bool) -> None:
+        self._servers[address] = ok
+        connected = any(self._servers.values())
+        if connected != self.connected:
+            self.connected = connected
+            if connected:
+                logger.info("[MONGO] MongoDB доступна")
+            else:
+                logger.warning("[MONGO] MongoDB недоступна, використовую локальне сховище")
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._update(event.connection_id, True)
+
+    def failed(self, event):
+        self._update(event.connection_id, False)
+
+
+def _uses_tls(mongo_uri: str) -> bool:
+    """Чи підключається URI через TLS: mongodb+srv:// вмикає його за замовчуванням,
+    а ssl= і tls= у параметрах — синоніми (Atlas у рядках без SRV пише ssl=true)"""
+    srv = mongo_uri.startswith('mongodb+srv://')
+    query = mongo_uri.split('?', 1)[1] if '?' in mongo_uri else ''
+    try:
+        tls = uri_parser.split_options(query).get('tls') if query else None
+    except Exception:
+        # Некоректні параметри відхилить сам MongoClient; CA-сертифікати не заважають
+        return True
+    return srv if tls is None else bool(tls)
+
+
+def _state_delta(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Мінімальне оновлення поля 'state' від old до new або None, якщо простіше записати його цілком.
+
+    Дописані в кінець вибори (add_choice) стають $push, вибори, прибрані за типом
+    (remove_choice_by_type) — $pull, решта змінених полів — $set окремих ключів.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict) or set(old) - set(new):
+        return None
+    delta: Dict[str, Dict[str, Any]] = {}
+    for key, value in new.items():
+        if key in old and old[key] == value:
+            continue
+        before = old.get(key)
+        if key == 'choices' and isinstance(before, list) and isinstance(value, list):
+            if value[:len(before)] == before:
+                delta['$push'] = {'state.choices': {'$each': value[len(before):]}}
+                continue
+            types = list(dict.fromkeys(choice.get('type') for choice in before
+                                       if isinstance(choice, dict) and choice not in value))
+            if types and value == [choice for choice in before
+                                   if not (isinstance(choice, dict) and choice.get('type') in types)]:
+                delta['$pull'] = {'state.choices': {'type': {'$in': types}}}
+                continue
+        delta.setdefault('$set', {})['state.' + key] = value
+    return delta
+
+
+class UserCache:
+    """Обмежений LRU-кеш документів користувачів з часом життя запису.
+
+    Заповнюється при читанні (get_user), а add_user скидає запис користувача, тож наступне
+    читання бере актуальний документ з MongoDB. TTL обмежує розбіжність зі змінами, зробленими
+    в обхід бота (наприклад, вручну в базі).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[float, dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, user_id: str, user: dict) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic(), dict(user))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def peek(self, user_id: str) -> Optional[dict]:
+        """Останній відомий документ незалежно від TTL (коли перечитати його з MongoDB неможливо)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return dict(entry[1]) if entry is not None else None
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
 class UserData:
-    def __init__(self, mongo_uri: Optional[str] = None):
+    def __init__(self, mongo_uri: Optional[str] = None, max_pool_size: int = MONGODB_MAX_POOL_SIZE,
+                 bulk_pool_size: int = MONGODB_BULK_POOL_SIZE, database: str = MONGODB_DATABASE):
+        # Без MongoDB — всі користувачі; з MongoDB — лише ще не записані в базу зміни користувачів
         self.users: Dict[str, dict] = {}
         self.filename = "users.json"
+        # Без MongoDB: знімок users.json плюс журнал змін, що лише дописується
+        self.journal = UserJournal(self.filename, "users.journal.jsonl")
+        self.conversations_journal = UserJournal("conversations.json", "conversations.journal.jsonl")
+        self.local_conversations: Dict[str, dict] = {}
+        self.health = MongoHealth()
         self.client: Optional[MongoClient] = None
         self.db: Optional[Database] = None
         self.users_collection: Optional[Collection] = None
         self.conversations: Optional[Collection] = None
+        # Ті самі колекції через клієнт для масових операцій
+        self.bulk_client: Optional[MongoClient] = None
+        self.bulk_users: Optional[Collection] = None
+        self.bulk_conversations: Optional[Collection] = None
+        # Останній незаписаний стан розмови кожного користувача
+        self._pending_states: Dict[int, Dict[str, Any]] = {}
+        self._states_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Останній записаний у MongoDB 'state' кожного користувача (версія, копія) — база для дельт;
+        # обмежений, як і кеш користувачів: для витісненого стан просто запишеться цілком
+        self._state_snapshots: 'OrderedDict[int, Tuple[int, dict]]' = OrderedDict()
+        # Користувачі, чиї незаписані зміни зроблено без відомого документа (див. FRESH_USER_FIELDS)
+        self._blind_users: set = set()
+        self._users_lock = threading.Lock()
+        self.cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
         
         # Спробуємо підключитися до MongoDB
         if mongo_uri:
             try:
                 logger.info("Спроба підключення до MongoDB...")
-                self.client = MongoClient(
-                    mongo_uri,
-                    tlsCAFile=certifi.where(),
-                    serverSelectionTimeoutMS=10000,
-                    connectTimeoutMS=10000,
-                    socketTimeoutMS=10000,
-                    maxPoolSize=1,
-                    waitQueueTimeoutMS=10000,
-                    retryWrites=True,
-                    w='majority'
-                )
+                self.client = self._connect(mongo_uri, max_pool_size, min(MONGODB_MIN_POOL_SIZE, max_pool_size))
                 
                 # Перевіряємо підключення
                 self.client.admin.command('ping')
                 
                 # Отримуємо базу даних
-                self.db = self.client.get_database('confetti')
+                self.db = self.client.get_database(database)
                 self.users_collection = self.db.users
                 self.conversations = self.db.conversations
+                if bulk_pool_size > 0:
+                    self.bulk_client = self._connect(mongo_uri, bulk_pool_size, 0)
+                    bulk_db = self.bulk_client.get_database(database)
+                else:
+                    bulk_db = self.db
+                self.bulk_users = bulk_db.users
+                self.bulk_conversations = bulk_db.conversations
                 
                 # Створюємо індекси
                 self._create_indexes()
                 
-                logger.info("Успішно підключено до MongoDB")
+                logger.info(f"Успішно підключено до MongoDB (пул {max_pool_size}, для масових операцій {bulk_pool_size})")
             except Exception as e:
                 logger.error(f"Помилка підключення до MongoDB: {str(e)}")
                 logger.info("Використовую локальне сховище")
                 self.client = None
+                self.bulk_client = None
                 self.users_collection = None
                 self.conversations = None
+                self.bulk_users = None
+                self.bulk_conversations = None
         else:
             logger.info("MONGODB_URI не знайдено, використовую локальне сховище")
             
         # Завантажуємо дані
         self.load_data()
 
+    def _connect(self, mongo_uri: str, max_pool_size: int, min_pool_size: int) -> MongoClient:
+        """Клієнт MongoDB з власним пулом з'єднань"""
+        options = {}
+        # Сертифікати certifi лише для TLS: будь-який tls*-параметр неявно вмикає TLS,
+        # і локальна MongoDB без TLS перестала б приймати підключення
+        if _uses_tls(mongo_uri):
+            options['tlsCAFile'] = certifi.where()
+        return MongoClient(
+            mongo_uri,
+            serverSelectionTimeoutMS=10000,
+            connectTimeoutMS=10000,
+            socketTimeoutMS=10000,
+            maxPoolSize=max_pool_size,
+            minPoolSize=min_pool_size,
+            waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+            retryWrites=True,
+            w='majority',
+            heartbeatFrequencyMS=MONGODB_HEARTBEAT_MS,
+            event_listeners=[self.health],
+            **options
+        )
+
     def _create_indexes(self):
         """Створення індексів для колекцій"""
         try:
@@ -81,6 +299,13 @@ class UserData:
                 unique=True,
                 partialFilterExpression={'user_id': {'$type': 'number'}}
             )
+            # Незавершені розмови PTB (conversation_docs при старті): в індексі лише документи,
+            # де вони є, — завершені розмови записуються як null і в нього не потрапляють
+            self.conversations.create_index(
+                [('last_update', 1)],
+                name='active_ptb_conversations',
+                partialFilterExpression={'ptb_conversations': {'$type': 'object'}}
+            )
             logger.info("Індекси успішно створено")
         except Exception as e:
             logger.error(f"Помилка створення індексів: {str(e)}")
@@ -88,118 +313,338 @@ class UserData:
     def load_data(self):
         """Завантаження даних з MongoDB або локального файлу"""
         if self.users_collection is not None:
+            # Повну колекцію не читаємо: користувачі завантажуються за потреби (get_user),
+            # а всю базу перебирає iter_users() — час старту не залежить від кількості користувачів.
+            # Журнал містить лише зміни, не записані в MongoDB до зупинки (знімок users.json не чіпаємо)
+            self.users = self.journal.replay()
+            self._blind_users = set(self.users)
+            # Так само стани розмов, збережені під час недоступності MongoDB
+            self.local_conversations = self.conversations_journal.replay()
+            logger.info("Дані користувачів читатимуться з MongoDB за потреби")
+        else:
             try:
-                cursor = self.users_collection.find({})
-                self.users = {str(doc['_id']): {k: v for k, v in doc.items() if k != '_id'} 
-                            for doc in cursor}
-                logger.info("Дані успішно завантажено з MongoDB")
+                self.users = self.journal.load()
+                self.local_conversations = self.conversations_journal.load()
+                logger.info("Дані успішно завантажено з локального сховища")
             except Exception as e:
-                logger.error(f"Помилка завантаження даних з MongoDB: {e}")
+                logger.error(f"Помилка читання локального сховища: {e}")
                 self.users = {}
-        else:
-            if os.path.exists(self.filename):
-                try:
-                    with open(self.filename, 'r', encoding='utf-8') as file:
-                        self.users = json.load(file)
-                    logger.info("Дані успішно завантажено з локального файлу")
-                except json.JSONDecodeError:
-                    logger.error("Помилка читання локального файлу")
-                    self.users = {}
 
     def save_data(self):
-        """Збереження даних в MongoDB або локальний файл"""
-        if self.users_collection is not None:
+        """Збереження змінених користувачів в MongoDB або всіх даних у локальний файл"""
+        if self.users_collection is not None and self.ensure_connected():
             try:
-                for user_id, user_data in self.users.items():
-                    self.users_collection.update_one(
-                        {'_id': user_id},
-                        {'$set': user_data},
-                        upsert=True
-                    )
-                logger.info("Дані успішно збережено в MongoDB")
+                self._save_dirty()
             except Exception as e:
                 logger.error(f"Помилка збереження в MongoDB: {e}")
                 self._save_local()
         else:
             self._save_local()
 
+    def _save_dirty(self) -> int:
+        """Записує в MongoDB незаписані зміни користувачів і прибирає їх з пам'яті"""
+        with self._users_lock:
+            pending = dict(self.users)
+            blind = set(self._blind_users)
+        if not pending:
+            return 0
+        started = time.perf_counter()
+        user_ids = list(pending)
+        upserted = modified = 0
+        for start in range(0, len(user_ids), SAVE_BATCH_SIZE):
+            batch_ids = user_ids[start:start + SAVE_BATCH_SIZE]
+            batch = [UpdateOne({'_id': user_id}, self._upsert(pending[user_id], user_id in blind), upsert=True)
+                     for user_id in batch_ids]
+            # Якщо запис не вдався, зміни залишаються в self.users до наступної спроби
+            result = self.bulk_users.bulk_write(batch, ordered=False)
+            upserted += result.upserted_count
+            modified += result.modified_count
+            self._forget_saved(pending, batch_ids)
+        logger.info(f"Дані успішно збережено в MongoDB: {len(user_ids)} змінених користувачів "
+                    f"(нових {upserted}, оновлено {modified}) за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return len(user_ids)
+
+    def _forget_saved(self, saved: Dict[str, dict], user_ids: List[str]) -> None:
+        """Прибирає записані зміни з пам'яті, якщо поки йшов запис не надійшли новіші"""
+        with self._users_lock:
+            for user_id in user_ids:
+                # add_user щоразу кладе новий словник, тож збіг об'єкта означає, що змін не було
+                if self.users.get(user_id) is saved[user_id]:
+                    del self.users[user_id]
+                    self._blind_users.discard(user_id)
+
+    @staticmethod
+    def _upsert(info: dict, blind: bool = False) -> dict:
+        """Оновлення документа користувача: created_at пишеться лише при створенні документа,
+        бо в пам'яті може не бути збереженої в базі дати"""
+        changes = {k: v for k, v in info.items() if k != 'created_at'}
+        on_insert = {'created_at': info['created_at']} if 'created_at' in info else {}
+        if blind:
+            # Зміну зроблено без відомого документа: не затираємо справжні значення обчисленими з порожнього
+            on_insert.update({k: v for k, v in changes.items() if k not in FRESH_USER_FIELDS or v is None})
+            changes = {k: v for k, v in changes.items() if k not in on_insert}
+        update = {'$set': changes}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        return update
+
+    def users_page(self, after: str = '', limit: int = USERS_PAGE_SIZE,
+                   fields: Optional[List[str]] = None) -> List[Tuple[str, dict]]:
+        """Сторінка користувачів з ідентифікатором більшим за after (впорядковано за ідентифікатором).
+
+        fields обмежує набір полів (проєкція), щоб не тягнути об'ємні поля на кшталт full_user_obj.
+        """
+        if self.users_collection is not None:
+            if not self.ensure_connected():
+                # У пам'яті лише незаписані зміни, а не самі користувачі
+                logger.error("MongoDB недоступна, перелік користувачів прочитати неможливо")
+                return []
+            try:
+                cursor = self.bulk_users.find({'_id': {'$gt': after}}, fields).sort('_id', 1).limit(limit)
+                return [(str(doc['_id']), {k: v for k, v in doc.items() if k != '_id'}) for doc in cursor]
+            except Exception as e:
+                logger.error(f"Помилка читання користувачів з MongoDB: {e}")
+                return []
+        user_ids = heapq.nsmallest(limit, (user_id for user_id in list(self.users) if user_id > after))
+        return [(user_id, {k: v for k, v in self.users[user_id].items() if fields is None or k in fields})
+                for user_id in user_ids]
+
+    def iter_users(self, fields: Optional[List[str]] = None) -> Iterator[Tuple[str, dict]]:
+        """Перебирає всіх користувачів сторінками по USERS_PAGE_SIZE"""
+        after = ''
+        while True:
+            page = self.users_page(after, USERS_PAGE_SIZE, fields)
+            yield from page
+            if len(page) < USERS_PAGE_SIZE:
+                return
+            after = page[-1][0]
+
     def _save_local(self):
-        """Збереження даних в локальний файл"""
+        """Збереження всіх даних у локальний знімок (журнал після цього очищується)"""
         try:
-            with open(self.filename, 'w', encoding='utf-8') as file:
-                json.dump(self.users, file, ensure_ascii=False, indent=2)
+            if self.users_collection is not None:
+                # У пам'яті лише незаписані зміни, і всі вони вже в журналі — знімок не перезаписуємо
+                self.journal.sync()
+                return
+            self.journal.compact(self.users)
             logger.info("Дані успішно збережено локально")
         except Exception as e:
             logger.error(f"Помилка збереження локально: {e}")
 
     def ensure_connected(self) -> bool:
-        """Перевірка підключення до MongoDB"""
-        if not self.client:
-            return False
-            
-        try:
-            self.client.server_info()
-            return True
-        except:
-            return False
+        """Перевірка підключення до MongoDB за останнім heartbeat (без запиту до сервера)"""
+        return self.client is not None and self.health.connected
 
     def save_conversation_state(self, user_id: int, state: Dict[str, Any]) -> bool:
-        """Зберігає стан розмови користувача"""
-        if self.conversations is not None and self.ensure_connected():
+        """Ставить стан розмови в буфер запису; в MongoDB він потрапить з найближчим flush_states()"""
+        # Копія: списки виборів у context.user_data змінюються далі, а буфер має зберегти цей момент
+        state = copy.deepcopy(state)
+        # Встановлюємо правильний user_id (int) для збереження
+        state['user_id'] = int(user_id)
+        # Оновлюємо last_update для експорту
+        state['last_update'] = datetime.now().isoformat()
+        if self.conversations is None:
             try:
-                # Встановлюємо правильний user_id (int) для збереження
-                state['user_id'] = int(user_id)
-                # Оновлюємо last_update для експорту
-                state['last_update'] = datetime.now().isoformat()
-                self.conversations.update_one(
-                    {'user_id': int(user_id)},
-                    {'$set': state},
-                    upsert=True
-                )
-                logger.info(f"Збережено стан розмови для користувача {user_id}")
+                self.local_conversations.setdefault(str(user_id), {}).update(state)
+                self.conversations_journal.append(str(user_id), state)
                 return True
             except Exception as e:
-                logger.error(f"Помилка збереження стану розмови: {str(e)}")
-        return False
+                logger.error(f"Помилка збереження стану розмови локально: {str(e)}")
+                return False
+        if self._buffer_state(int(user_id), state):
+            self.flush_states()
+        return True
+
+    def _buffer_state(self, user_id: int, changes: Dict[str, Any]) -> bool:
+        """Додає зміни стану розмови в буфер запису, а поки MongoDB недоступна — в локальний журнал.
+
+        Незаписані зміни одного користувача лежать лише в одному з цих двох місць, тож новіші
+        ніколи не перекриваються старішими. Повертає True, коли буфер пора скинути.
+        """
+        str_id = str(user_id)
+        with self._states_lock:
+            if not self.ensure_connected():
+                # Буфер у пам'яті не росте під час збою: зміни дочекаються MongoDB у журналі
+                changes = {**self._pending_states.pop(user_id, {}), **changes}
+                self.local_conversations[str_id] = {**self.local_conversations.get(str_id, {}), **changes}
+                self.conversations_journal.append(str_id, changes)
+                return False
+            # Кілька $set одного користувача між скиданнями зливаються в один
+            self._pending_states[user_id] = {**self._pending_states.get(user_id, {}),
+                                             **self.local_conversations.pop(str_id, {}), **changes}
+            return len(self._pending_states) >= STATE_FLUSH_MAX_USERS
+
+    def flush_states(self) -> int:
+        """Записує накопичені стани розмов одним bulk_write; повертає кількість користувачів"""
+        # Скидання йдуть по черзі, інакше старіший пакет міг би записатися після новішого
+        with self._flush_lock:
+            if self.conversations is None or not self.ensure_connected():
+                return 0
+            with self._states_lock:
+                # Стани, збережені в журнал під час збою, тепер ідуть у MongoDB разом з буфером
+                for str_id, doc in self.local_conversations.items():
+                    self._pending_states[int(str_id)] = {**self._pending_states.get(int(str_id), {}), **doc}
+                self.local_conversations = {}
+                pending, self._pending_states = self._pending_states, {}
+            if not pending:
+                return 0
+            user_ids = list(pending)
+            updates = {user_id: self._state_update(user_id, pending[user_id]) for user_id in user_ids}
+            failed: set = set()
+            conflicts: List[int] = []
+            # Повні записи створюють документ (upsert), дельти — лише оновлюють наявний
+            full = [user_id for user_id in user_ids if not updates[user_id][2]]
+            deltas = [user_id for user_id in user_ids if updates[user_id][2]]
+            for batch in (full, deltas):
+                if not batch:
+                    continue
+                errors: set = set()
+                try:
+                    result = self.bulk_conversations.bulk_write([updates[user_id][0] for user_id in batch], ordered=False)
+                    matched = result.matched_count
+                except BulkWriteError as e:
+                    errors = {batch[error['index']] for error in e.details.get('writeErrors', [])}
+                    matched = e.details.get('nMatched', 0)
+                except Exception as e:
+                    logger.error(f"Помилка збереження станів розмов: {str(e)}")
+                    failed.update(batch)
+                    continue
+                failed |= errors
+                if batch is deltas and matched < len(batch) - len(errors):
+                    conflicts.extend(self._missed_deltas([user_id for user_id in batch if user_id not in errors],
+                                                         updates))
+            failed.update(conflicts)
+            for user_id in user_ids:
+                snapshot = updates[user_id][1]
+                if user_id in failed:
+                    # Після помилки чи конфлікту стан у базі невідомий — наступний запис буде повним
+                    self._state_snapshots.pop(user_id, None)
+                elif snapshot is not None:
+                    self._state_snapshots[user_id] = snapshot
+                    self._state_snapshots.move_to_end(user_id)
+            while len(self._state_snapshots) > USER_CACHE_SIZE:
+                self._state_snapshots.popitem(last=False)
+            if failed:
+                if conflicts:
+                    logger.warning(f"Конфлікт версій стану розмови для користувачів {conflicts}, стан буде записано повністю")
+                with self._states_lock:
+                    # Повертаємо в буфер, не затираючи зміни, що надійшли під час запису
+                    for user_id in failed:
+                        local = self.local_conversations.get(str(user_id))
+                        if local is not None:
+                            # MongoDB впала під час запису, і новіші зміни вже пішли в журнал:
+                            # невдалий пакет лягає під них, а не в буфер, щоб не перекрити їх при наступному скиданні
+                            merged = self.local_conversations[str(user_id)] = {**pending[user_id], **local}
+                            self.conversations_journal.append(str(user_id), merged)
+                        else:
+                            self._pending_states[user_id] = {**pending[user_id], **self._pending_states.get(user_id, {})}
+            written = len(user_ids) - len(failed)
+            if written:
+                logger.info(f"Збережено стан розмови для {written} користувачів")
+            return written
+
+    def _missed_deltas(self, user_ids: List[int], updates: Dict[int, tuple]) -> List[int]:
+        """Дельти, які не знайшли свого документа (версія змінилась або документ зник)"""
+        try:
+            docs = self.bulk_conversations.find({'user_id': {'$in': user_ids}}, {'user_id': 1, 'state_version': 1})
+            # Застосована дельта записала нову версію зі свого знімка
+            applied = {doc['user_id'] for doc in docs
+                       if not STATE_VERSION_CHECK or doc.get('state_version') == updates[doc['user_id']][1][0]}
+        except Exception as e:
+            logger.error(f"Помилка перевірки версій станів розмов: {str(e)}")
+            applied = set()
+        return [user_id for user_id in user_ids if user_id not in applied]
+
+    def _state_update(self, user_id: int, changes: Dict[str, Any]) -> Tuple[UpdateOne, Optional[Tuple[int, dict]], bool]:
+        """Запит на запис змін одного користувача, новий знімок його 'state' (якщо він змінився)
+        і чи є запит дельтою до відомої версії (такий запит не створює документ)"""
+        changes = dict(changes)
+        state = changes.pop('state', None)
+        query: Dict[str, Any] = {'user_id': user_id}
+        update: Dict[str, Dict[str, Any]] = {'$set': changes}
+        if state is None:
+            return UpdateOne(query, update, upsert=True), None, False
+        known = self._state_snapshots.get(user_id)
+        delta = _state_delta(known[1], state) if known is not None else None
+        if delta is None:
+            changes['state'] = state
+        else:
+            changes.update(delta.pop('$set', {}))
+            update.update(delta)
+            if STATE_VERSION_CHECK:
+                query['state_version'] = known[0]
+        version = time.time_ns()
+        if STATE_VERSION_CHECK:
+            changes['state_version'] = version
+        # Дельта без upsert: якщо версія не збіглася, запит нічого не змінює, а не створює другий документ
+        return UpdateOne(query, update, upsert=delta is None), (version, copy.deepcopy(state)), delta is not None
 
     def get_conversation_state(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Отримує стан розмови користувача"""
+        """Отримує стан розмови користувача (з урахуванням ще не записаних змін)"""
+        with self._states_lock:
+            pending = dict(self._pending_states.get(int(user_id), {}))
+            if self.conversations is not None:
+                # Зміни, збережені в журнал, поки MongoDB була недоступна, — новіші за буфер
+                pending = {**pending, **self.local_conversations.get(str(user_id), {})}
+        state = None
         if self.conversations is not None and self.ensure_connected():
             try:
                 # user_id має бути int
                 state = self.conversations.find_one({'user_id': int(user_id)})
                 if state:
                     state.pop('_id', None)
-                return state
             except Exception as e:
                 logger.error(f"Помилка отримання стану розмови: {str(e)}")
-        return None
+        elif self.conversations is None and str(user_id) in self.local_conversations:
+            state = dict(self.local_conversations[str(user_id)])
+        if pending:
+            state = {**(state or {}), **pending}
+        return state
+
+    def conversation_docs(self, field: str, since: Optional[str] = None) -> List[Tuple[str, dict]]:
+        """Стани розмов, у яких поле field не порожнє (наприклад, незавершені розмови при старті бота).
+
+        since (ISO-час) відкидає стани, які не змінювались відтоді.
+        """
+        docs: Dict[str, dict] = {}
+        if self.conversations is not None and self.ensure_connected():
+            query: Dict[str, Any] = {field: {'$type': 'object', '$ne': {}}}
+            if since:
+                query['last_update'] = {'$gte': since}
+            try:
+                for doc in self.bulk_conversations.find(query):
+                    doc.pop('_id', None)
+                    docs[str(doc['user_id'])] = doc
+            except Exception as e:
+                logger.error(f"Помилка читання станів розмов: {str(e)}")
+        elif self.conversations is None:
+            docs = {user_id: dict(doc) for user_id, doc in list(self.local_conversations.items())}
+        with self._states_lock:
+            for user_id, state in self._pending_states.items():
+                docs[str(user_id)] = {**docs.get(str(user_id), {}), **state}
+            if self.conversations is not None:
+                # Зміни з журналу збою новіші за буфер
+                for user_id, state in self.local_conversations.items():
+                    docs[user_id] = {**docs.get(user_id, {}), **state}
+        return [(user_id, doc) for user_id, doc in docs.items()
+                if doc.get(field) and (not since or str(doc.get('last_update') or '') >= since)]
 
     def clear_conversation_state(self, user_id: Union[str, int]) -> None:
         """Очищає стан розмови для конкретного користувача"""
         user_id = str(user_id)
         try:
-            if self.conversations is not None and self.ensure_connected():
-                self.conversations.update_one(
-                    {'user_id': user_id},
-                    {'$set': {'state': {}, 'last_updated': datetime.now()}},
-                    upsert=True
-                )
+            if self.conversations is not None:
+                # Порожній 'state' перекриває незаписаний вибір; інші поля (дані PTB) залишаються
+                self._buffer_state(int(user_id), {
+                    'user_id': int(user_id), 'state': {}, 'last_updated': datetime.now()
+                })
             else:
-                if not os.path.exists(self.filename):
-                    with open(self.filename, 'w') as f:
-                        json.dump({}, f)
-                
-                with open(self.filename, 'r') as f:
-                    conversations = json.load(f)
-                
-                conversations[user_id] = {
+                cleared = {
                     'state': {},
                     'last_updated': datetime.now().isoformat()
                 }
-                
-                with open(self.filename, 'w') as f:
-                    json.dump(conversations, f)
+                self.local_conversations.setdefault(user_id, {}).update(cleared)
+                self.conversations_journal.append(user_id, cleared)
                 
         except Exception as e:
             logger.error(f"Помилка при очищенні стану розмови для користувача {user_id}: {e}")
@@ -210,8 +655,11 @@ class UserData:
         """Додає нового користувача або оновлює існуючого, не затираючи старі дані та синхронізуючи _id/user_id"""
         try:
             str_id = str(user_id)
+            if self.users_collection is not None:
+                return self._add_user_mongo(str_id, int(user_id), user_info)
             # Оновлюємо лише ті поля, що є у user_info, інші залишаємо
-            old_info = self.users.get(str_id, {}).copy()
+            previous = self.users.get(str_id, {})
+            old_info = previous.copy()
             old_info.update(user_info)
             # Не перезаписуємо created_at, якщо він вже існує
             old_info['created_at'] = old_info.get('created_at', datetime.now().isoformat())
@@ -219,15 +667,10 @@ class UserData:
             old_info['_id'] = str_id
             old_info['user_id'] = int(user_id)
             self.users[str_id] = old_info
-
-            if self.users_collection is not None and self.ensure_connected():
-                self.users_collection.update_one(
-                    {'_id': str_id},
-                    {'$set': old_info},
-                    upsert=True
-                )
-            else:
-                self.save_data()
+            # У журнал дописуються лише змінені поля
+            changes = {k: v for k, v in old_info.items() if k not in previous or previous[k] != v}
+            if changes:
+                self.journal.append(str_id, changes)
 
             logger.info(f"Додано/оновлено користувача: {user_id}")
             return True
@@ -235,19 +678,162 @@ class UserData:
             logger.error(f"Помилка додавання користувача: {str(e)}")
             return False
 
+    def _add_user_mongo(self, str_id: str, user_id: int, user_info: dict) -> bool:
+        """add_user з MongoDB: зміни пишуться одразу, а при збої лишаються в пам'яті та журналі до flush()"""
+        changes = dict(user_info)
+        changes.setdefault('created_at', datetime.now().isoformat())
+        changes['_id'] = str_id
+        changes['user_id'] = user_id
+        with self._users_lock:
+            if str_id not in self.users and self.cache.peek(str_id) is None and not self.ensure_connected():
+                self._blind_users.add(str_id)
+            # Новий словник, а не зміна старого: _forget_saved порівнює об'єкти
+            record = self.users[str_id] = {**self.users.get(str_id, {}), **changes}
+            blind = str_id in self._blind_users
+        if self.ensure_connected():
+            self.cache.invalidate(str_id)
+            try:
+                self.users_collection.update_one({'_id': str_id}, self._upsert(record, blind), upsert=True)
+                self._forget_saved({str_id: record}, [str_id])
+                logger.info(f"Додано/оновлено користувача: {user_id}")
+                return True
+            except PyMongoError as e:
+                logger.error(f"Помилка запису користувача {user_id} в MongoDB, збережено в журнал: {e}")
+        # До MongoDB користувач потрапить з найближчим flush(), щойно вона стане доступною
+        with self._users_lock:
+            self.journal.append(str_id, changes)
+        logger.info(f"Додано/оновлено користувача: {user_id}")
+        return True
+
+    def flush(self) -> None:
+        """Скидає буфер станів розмов і користувачів, змінених поки MongoDB була недоступна"""
+        self.flush_states()
+        if self.users and self.users_collection is not None and self.ensure_connected():
+            self.save_data()
+        try:
+            self.journal.sync()
+            self.conversations_journal.sync()
+            if self.users_collection is not None:
+                with self._users_lock:
+                    # Журнал потрібен лише доки є незаписані в MongoDB зміни
+                    if not self.users:
+                        self.journal.truncate()
+            elif self.journal.needs_compaction():
+                self.journal.compact(self.users)
+            if self.conversations is not None:
+                with self._flush_lock, self._states_lock:
+                    if not self.local_conversations and not self._pending_states:
+                        self.conversations_journal.truncate()
+            elif self.conversations_journal.needs_compaction():
+                self.conversations_journal.compact(self.local_conversations)
+        except Exception as e:
+            logger.error(f"Помилка збереження локального журналу: {e}")
+
+    def close(self) -> None:
+        """Скидає всі буфери та закриває журнали (при зупинці бота)"""
+        self.flush()
+        self.journal.close()
+        self.conversations_journal.close()
+        for client in (self.client, self.bulk_client):
+            if client is not None:
+                client.close()
+        logger.info(f"Кеш користувачів: {self.cache.stats()}")
+
     def get_user(self, user_id: int) -> Optional[dict]:
         """Отримує інформацію про користувача"""
         try:
             str_id = str(user_id)
-            if self.users_collection is not None and self.ensure_connected():
-                user = self.users_collection.find_one({'_id': str_id})
-                if user:
-                    return {k: v for k, v in user.items() if k != '_id'}
-            return self.users.get(str_id)
+            if self.users_collection is None:
+                return self.users.get(str_id)
+            user = None
+            if self.ensure_connected():
+                try:
+                    user = self.cache.get(str_id)
+                    if user is None:
+                        user = self.users_collection.find_one({'_id': str_id})
+                        if user:
+                            user = {k: v for k, v in user.items() if k != '_id'}
+                            self.cache.put(str_id, user)
+                except PyMongoError as e:
+                    logger.error(f"Помилка читання користувача з MongoDB: {e}")
+                    user = self.cache.peek(str_id)
+            else:
+                # MongoDB недоступна: останній прочитаний документ, навіть застарілий, краще за жоден —
+                # інакше обробник вважатиме відомого користувача новим
+                user = self.cache.peek(str_id)
+            pending = self.users.get(str_id)
+            if pending:
+                user = {**(user or {}), **{k: v for k, v in pending.items() if k != '_id'}}
+            return user
         except Exception as e:
             logger.error(f"Помилка отримання користувача: {str(e)}")
             return None
 
+class AsyncUserData:
+    """Асинхронний фасад над UserData для обробників бота.
+
+    pymongo 4.6 має лише синхронний API, тому кожен виклик виконується у власному пулі потоків,
+    розміром з пули з'єднань: поки один користувач чекає на MongoDB, цикл подій обслуговує
+    інших, а важка робота з медіа в asyncio.to_thread не забирає потоки в запитів до бази.
+    """
+
+    def __init__(self, sync: UserData, max_workers: int = MONGODB_MAX_POOL_SIZE + MONGODB_BULK_POOL_SIZE):
+        self.sync = sync
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='user_data')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def get_user(self, user_id: int) -> Optional[dict]:
+        return await self._run(self.sync.get_user, user_id)
+
+    async def add_user(self, user_id: int, user_info: dict) -> bool:
+        return await self._run(self.sync.add_user, user_id, user_info)
+
+    async def save_conversation_state(self, user_id: int, state: Dict[str, Any]) -> bool:
+        return await self._run(self.sync.save_conversation_state, user_id, state)
+
+    async def get_conversation_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._run(self.sync.get_conversation_state, user_id)
+
+    async def clear_conversation_state(self, user_id: Union[str, int]) -> None:
+        await self._run(self.sync.clear_conversation_state, user_id)
+
+    async def conversation_docs(self, field: str, since: Optional[str] = None) -> List[Tuple[str, dict]]:
+        return await self._run(self.sync.conversation_docs, field, since)
+
+    async def flush(self) -> None:
+        await self._run(self.sync.flush)
+
+    async def iter_users(self, fields: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, dict]]:
+        """Перебирає всіх користувачів; кожна сторінка читається в потоці"""
+        after = ''
+        while True:
+            page = await self._run(self.sync.users_page, after, USERS_PAGE_SIZE, fields)
+            for item in page:
+                yield item
+            if len(page) < USERS_PAGE_SIZE:
+                return
+            after = page[-1][0]
+
+    async def run_flusher(self) -> None:
+        """Фонова задача: скидає буфери записів раз на STATE_FLUSH_INTERVAL_MS"""
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL_MS / 1000)
+            await self._run(self.sync.flush)
+
+    async def close(self) -> None:
+        """Записує все, що залишилось у буферах (при зупинці бота)"""
+        await self._run(self.sync.close)
+        self.executor.shutdown(wait=False)
+
+
 # Створення глобального екземпляра
 mongo_uri = os.getenv('MONGODB_URI')
-user_data = UserData(mongo_uri) 
+if USER_STORAGE == 'sqlite':
+    from user_sqlite import SQLiteUserData
+    user_data = SQLiteUserData(SQLITE_FILE)
+else:
+    user_data = UserData(mongo_uri)
+async_user_data = AsyncUserData(user_data)
+
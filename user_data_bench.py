@@ -0,0 +1,252 @@
+"""Навантажувальний тест сховища користувачів з різними розмірами пулу з'єднань.
+
+Запускає N одночасних імітованих розмов (/start, кроки вибору зі збереженням стану, контакт)
+через AsyncUserData і для кожного налаштування пулу друкує пропускну здатність та p99.
+
+    python user_data_bench.py --pools 1,4,10 --conversations 200
+    python user_data_bench.py --uri mongodb://localhost:27017 --pools 1,10
+    python user_data_bench.py --check
+
+Без --uri використовується імітація MongoDB у процесі: кожен запит займає одне «з'єднання»
+пулу на --latency-ms мілісекунд, тож видно саме чергу за з'єднаннями.
+"""
+import os
+import copy
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from user_data import UserData, AsyncUserData
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+
+class StandInResult:
+    def __init__(self, upserted: int, modified: int, matched: int):
+        self.upserted_count = upserted
+        self.modified_count = modified
+        self.matched_count = matched
+
+
+class StandInPool:
+    """Пул з'єднань: не більше max_pool_size запитів одночасно, кожен триває latency секунд"""
+
+    def __init__(self, max_pool_size: int, latency: float):
+        self._connections = threading.BoundedSemaphore(max_pool_size)
+        self.latency = latency
+
+    def run(self, operation):
+        with self._connections:
+            time.sleep(self.latency)
+            return operation()
+
+    def close(self):
+        pass
+
+
+class StandInCollection:
+    """Колекція в пам'яті з тими операціями, які використовує UserData"""
+
+    def __init__(self, pool: StandInPool, docs: Dict, key: str):
+        self.pool = pool
+        self.docs = docs
+        self.key = key
+        self._lock = threading.Lock()
+
+    def _apply(self, query: dict, update: dict, upsert: bool) -> str:
+        """Застосовує оновлення; повертає 'upserted', 'matched' або 'missed'"""
+        with self._lock:
+            doc_id = query[self.key]
+            doc = self.docs.get(doc_id)
+            if doc is not None and any(doc.get(field) != value for field, value in query.items()):
+                # Інші умови запиту (state_version) не збіглися; upsert у справжній базі тут
+                # спробував би створити другий документ і впертися в унікальний індекс
+                return 'missed'
+            if doc is None:
+                if not upsert:
+                    return 'missed'
+                doc = self.docs[doc_id] = dict(query)
+                doc.update(update.get('$setOnInsert', {}))
+                result = 'upserted'
+            else:
+                result = 'matched'
+            for field, value in update.get('$set', {}).items():
+                self._target(doc, field)[field.rsplit('.', 1)[-1]] = value
+            for field, value in update.get('$push', {}).items():
+                items = self._target(doc, field).setdefault(field.rsplit('.', 1)[-1], [])
+                items.extend(value['$each'] if isinstance(value, dict) and '$each' in value else [value])
+            for field, condition in update.get('$pull', {}).items():
+                parent = self._target(doc, field)
+                name = field.rsplit('.', 1)[-1]
+                parent[name] = [item for item in parent.get(name, []) if not self._matches(item, condition)]
+            return result
+
+    @staticmethod
+    def _target(doc: dict, field: str) -> dict:
+        """Словник, у якому лежить останній ключ шляху 'a.b.c'"""
+        for part in field.split('.')[:-1]:
+            doc = doc.setdefault(part, {})
+        return doc
+
+    @staticmethod
+    def _matches(item, condition) -> bool:
+        if not isinstance(condition, dict):
+            return item == condition
+        return isinstance(item, dict) and all(
+            item.get(field) in value['$in'] if isinstance(value, dict) and '$in' in value else item.get(field) == value
+            for field, value in condition.items()
+        )
+
+    @staticmethod
+    def _result(outcomes: List[str]) -> StandInResult:
+        upserted = outcomes.count('upserted')
+        matched = outcomes.count('matched')
+        return StandInResult(upserted, matched, matched)
+
+    def find_one(self, query: dict) -> Optional[dict]:
+        return self.pool.run(lambda: copy.deepcopy(self.docs[query[self.key]]) if query[self.key] in self.docs else None)
+
+    def find(self, query: dict, projection: Optional[dict] = None) -> List[dict]:
+        """Лише запит за списком ключів ({key: {'$in': [...]}}), який робить перевірка версій"""
+        keys = query[self.key]['$in']
+        return self.pool.run(lambda: [
+            {field: value for field, value in self.docs[key].items() if projection is None or field in projection}
+            for key in keys if key in self.docs
+        ])
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False):
+        return self._result([self.pool.run(lambda: self._apply(query, update, upsert))])
+
+    def bulk_write(self, requests: list, ordered: bool = True):
+        return self._result(self.pool.run(lambda: [self._apply(op._filter, op._doc, op._upsert) for op in requests]))
+
+
+def standin_user_data(max_pool_size: int, bulk_pool_size: int, latency: float) -> UserData:
+    """UserData, підключений до імітації MongoDB замість справжнього сервера"""
+    store = UserData(None)
+    users: Dict = {}
+    conversations: Dict = {}
+    pool = StandInPool(max_pool_size, latency)
+    bulk_pool = StandInPool(bulk_pool_size, latency) if bulk_pool_size > 0 else pool
+    store.client = pool
+    store.users_collection = StandInCollection(pool, users, '_id')
+    store.conversations = StandInCollection(pool, conversations, 'user_id')
+    store.bulk_users = StandInCollection(bulk_pool, users, '_id')
+    store.bulk_conversations = StandInCollection(bulk_pool, conversations, 'user_id')
+    store.health.connected = True
+    return store
+
+
+def check_outage_during_flush() -> None:
+    """Перевірка: MongoDB впала посеред bulk_write, а новіший стан тим часом пішов у журнал.
+
+    Після відновлення в базі має опинитися саме новіший стан, а не повернутий у буфер старіший.
+    """
+    store = standin_user_data(1, 0, 0)
+    collection = store.bulk_conversations
+    store.save_conversation_state(1, {'state': {'last_state': 'A'}})
+
+    def dropped(requests: list, ordered: bool = True):
+        # Під час запису зв'язок зник, обробник встиг зберегти новий стан, а запит завершився помилкою
+        store.health.connected = False
+        store.save_conversation_state(1, {'state': {'last_state': 'B'}})
+        raise ConnectionError("з'єднання з MongoDB втрачено")
+
+    collection.bulk_write, original = dropped, collection.bulk_write
+    store.flush_states()
+    collection.bulk_write = original
+    assert store.get_conversation_state(1)['state'] == {'last_state': 'B'}, store.get_conversation_state(1)
+    store.health.connected = True
+    store.flush_states()
+    written = collection.docs[1]['state']
+    assert written == {'last_state': 'B'}, f"записано старіший стан: {written}"
+    print("Перевірка збою під час скидання станів: OK")
+
+
+async def conversation(store: AsyncUserData, user_id: int, steps: int, latencies: List[float]) -> None:
+    """Одна розмова: /start, кроки вибору, надсилання контакту"""
+    async def timed(call):
+        started = time.perf_counter()
+        result = await call
+        latencies.append(time.perf_counter() - started)
+        return result
+
+    await timed(store.clear_conversation_state(user_id))
+    old_user = await timed(store.get_user(user_id))
+    visits = (old_user or {}).get('visits', 0) + 1
+    await timed(store.add_user(user_id, {'first_name': f'user{user_id}', 'chat_id': user_id, 'visits': visits}))
+    choices = []
+    for step in range(steps):
+        choices.append({'type': f'step{step}', 'value': f'value{step}'})
+        await timed(store.save_conversation_state(user_id, {'state': {'choices': list(choices), 'last_state': step}}))
+    old_user = await timed(store.get_user(user_id))
+    await timed(store.add_user(user_id, dict(old_user or {}, phone_number='+380000000000')))
+
+
+async def run_setting(store: AsyncUserData, conversations: int, steps: int) -> dict:
+    latencies: List[float] = []
+    flusher = asyncio.create_task(store.run_flusher())
+    started = time.perf_counter()
+    await asyncio.gather(*(conversation(store, user_id, steps, latencies) for user_id in range(1, conversations + 1)))
+    elapsed = time.perf_counter() - started
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    await store.close()
+    latencies.sort()
+    return {
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uri', help="MongoDB для тесту (база confetti_bench видаляється після тесту); "
+                                      "без нього — імітація в процесі")
+    parser.add_argument('--pools', default='1,4,10', help="розміри пулу через кому")
+    parser.add_argument('--bulk-pool', type=int, default=2, help="пул для масових операцій (0 — спільний)")
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--steps', type=int, default=8, help="кроків зі збереженням стану в одній розмові")
+    parser.add_argument('--latency-ms', type=float, default=2.0, help="тривалість запиту в імітації")
+    parser.add_argument('--check', action='store_true', help="лише перевірити порядок станів при збої MongoDB")
+    args = parser.parse_args()
+
+    # user_data вже налаштував логування на INFO — у тесті потрібні лише попередження
+    logging.getLogger().setLevel(logging.WARNING)
+    # Локальне сховище UserData пише файли в поточний каталог — тест не повинен чіпати справжні
+    os.chdir(tempfile.mkdtemp(prefix='user_data_bench_'))
+    if args.check:
+        check_outage_during_flush()
+        return
+
+    print(f"{'пул':>5} {'масові':>7} {'операцій':>9} {'с':>7} {'оп/с':>9} {'p50, мс':>9} {'p99, мс':>9}")
+    for pool_size in [int(size) for size in args.pools.split(',')]:
+        if args.uri:
+            sync = UserData(args.uri, max_pool_size=pool_size, bulk_pool_size=args.bulk_pool, database='confetti_bench')
+            if sync.client is None:
+                raise SystemExit(f"Не вдалося підключитися до {args.uri}")
+            sync.client.drop_database('confetti_bench')
+            sync._create_indexes()
+        else:
+            sync = standin_user_data(pool_size, args.bulk_pool, args.latency_ms / 1000)
+        store = AsyncUserData(sync, max_workers=pool_size + max(args.bulk_pool, 0))
+        result = asyncio.run(run_setting(store, args.conversations, args.steps))
+        if args.uri:
+            # Клієнти тесту вже закриті разом зі сховищем
+            client = sync._connect(args.uri, 1, 0)
+            client.drop_database('confetti_bench')
+            client.close()
+        print(f"{pool_size:>5} {args.bulk_pool:>7} {result['ops']:>9} {result['seconds']:>7.2f} "
+              f"{result['throughput']:>9.0f} {result['p50']:>9.2f} {result['p99']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
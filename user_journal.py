@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Як часто журнал примусово скидається на диск (fsync), мілісекунди: межа втрати даних при збої ОС
+JOURNAL_FSYNC_MS = int(os.getenv('JOURNAL_FSYNC_MS', '200'))
+# Розмір журналу, після якого він згортається у знімок
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_MB', '1')) * 1024 * 1024
+
+
+class UserJournal:
+    """Локальне сховище: JSON-знімок плюс журнал змін у форматі JSONL.
+
+    Кожна зміна — це один дописаний рядок {"id": ..., "set": {...}} замість перезапису всього
+    файлу; fsync виконується не частіше ніж раз на JOURNAL_FSYNC_MS. Коли журнал виростає,
+    compact() записує новий знімок і очищає журнал. При старті знімок читається, а журнал
+    накладається поверх нього.
+    """
+
+    def __init__(self, snapshot: str, journal: str):
+        self.snapshot = snapshot
+        self.journal = journal
+        self._file = None
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._unsynced = 0
+
+    def load(self) -> Dict[str, dict]:
+        """Читає знімок і відтворює журнал поверх нього"""
+        records: Dict[str, dict] = {}
+        if os.path.exists(self.snapshot):
+            try:
+                with open(self.snapshot, 'r', encoding='utf-8') as file:
+                    records = json.load(file)
+            except json.JSONDecodeError:
+                logger.error(f"Помилка читання знімка {self.snapshot}")
+        replayed = self._replay(records)
+        logger.info(f"Завантажено {len(records)} записів з {self.snapshot} (з журналу: {replayed})")
+        return records
+
+    def replay(self) -> Dict[str, dict]:
+        """Лише зміни з журналу, без знімка (записи, які ще не потрапили в основне сховище)"""
+        records: Dict[str, dict] = {}
+        replayed = self._replay(records)
+        if replayed:
+            logger.info(f"Відтворено {replayed} змін {len(records)} записів з журналу {self.journal}")
+        return records
+
+    def _replay(self, records: Dict[str, dict]) -> int:
+        replayed = 0
+        if os.path.exists(self.journal):
+            with open(self.journal, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописаний останній рядок після аварійної зупинки
+                        logger.warning(f"Пропущено пошкоджений запис журналу {self.journal}")
+                        continue
+                    records.setdefault(change['id'], {}).update(change['set'])
+                    replayed += 1
+        return replayed
+
+    def append(self, record_id: str, changes: Dict[str, Any]) -> None:
+        """Дописує зміни одного запису в журнал"""
+        line = json.dumps({'id': record_id, 'set': changes}, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.journal, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if time.monotonic() - self._last_sync >= JOURNAL_FSYNC_MS / 1000:
+                self._sync()
+
+    def sync(self) -> None:
+        """Скидає на диск записи, що ще не пройшли fsync"""
+        with self._lock:
+            self._sync()
+
+    def _sync(self) -> None:
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def needs_compaction(self) -> bool:
+        try:
+            return os.path.getsize(self.journal) >= JOURNAL_COMPACT_BYTES
+        except OSError:
+            return False
+
+    def compact(self, records: Dict[str, dict]) -> None:
+        """Записує повний знімок і очищає журнал"""
+        with self._lock:
+            # Копія під блокуванням: зміни, що дописуються паралельно, потраплять у новий журнал
+            data = dict(records)
+            tmp = self.snapshot + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False, indent=2, default=str)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.snapshot)
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.journal, 'w', encoding='utf-8')
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+        logger.info(f"Журнал згорнуто у знімок {self.snapshot}: {len(data)} записів")
+
+    def truncate(self) -> None:
+        """Очищає журнал, не чіпаючи знімок (усі зміни вже записані в основне сховище)"""
+        with self._lock:
+            if not os.path.exists(self.journal) or os.path.getsize(self.journal) == 0:
+                return
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.journal, 'w', encoding='utf-8')
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+        logger.info(f"Журнал {self.journal} очищено: всі зміни записані")
+
+    def close(self) -> None:
+        with self._lock:
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
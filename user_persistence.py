@@ -0,0 +1,140 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from user_data import AsyncUserData
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+# Як часто PTB передає змінені context.user_data та bot_data на збереження (секунди)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '10'))
+# Розмови, не змінені довше за стільки годин, при старті не відновлюються (0 — відновлювати всі)
+CONVERSATION_TTL_HOURS = float(os.getenv('PERSISTENCE_CONVERSATION_TTL_HOURS', '72'))
+
+# Поля документа стану розмови користувача, які належать PTB
+CONVERSATIONS_FIELD = 'ptb_conversations'
+USER_DATA_FIELD = 'ptb_user_data'
+BOT_DATA_FIELD = 'ptb_bot_data'
+# Документ з bot_data: ідентифікатори користувачів Telegram завжди додатні
+BOT_DATA_ID = 0
+
+
+def _encode_key(key: Tuple[int, ...]) -> str:
+    return json.dumps(list(key))
+
+
+def _decode_key(key: str) -> Tuple[int, ...]:
+    return tuple(json.loads(key))
+
+
+class UserDataPersistence(BasePersistence):
+    """Збереження станів ConversationHandler, context.user_data та bot_data через UserData.
+
+    Все лежить у документі стану розмови користувача (колекція conversations), поруч зі
+    станом, який пише save_state(). При старті читаються лише незавершені розмови, змінені
+    за останні CONVERSATION_TTL_HOURS, та user_data їхніх учасників; дані решти користувачів підвантажуються з першим оновленням
+    від них (refresh_user_data). Зміни станів проходять через буфер запису UserData,
+    а user_data/bot_data PTB передає пакетами раз на update_interval.
+    """
+
+    def __init__(self, store: AsyncUserData, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.store = store
+        # Документи незавершених розмов, прочитані при старті
+        self._active: Optional[Dict[str, dict]] = None
+        # user_id -> назва обробника -> закодований ключ розмови -> стан
+        self._conversations: Dict[int, Dict[str, Dict[str, object]]] = {}
+        self._loaded_users: set = set()
+
+    async def _load_active(self) -> Dict[str, dict]:
+        if self._active is None:
+            since = None
+            if CONVERSATION_TTL_HOURS > 0:
+                since = (datetime.now() - timedelta(hours=CONVERSATION_TTL_HOURS)).isoformat()
+            self._active = dict(await self.store.conversation_docs(CONVERSATIONS_FIELD, since))
+            logger.info(f"[PERSISTENCE] Незавершених розмов: {len(self._active)}")
+        return self._active
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        user_data = {}
+        for user_id, doc in (await self._load_active()).items():
+            self._loaded_users.add(int(user_id))
+            if doc.get(USER_DATA_FIELD):
+                user_data[int(user_id)] = doc[USER_DATA_FIELD]
+        return user_data
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        doc = await self.store.get_conversation_state(BOT_DATA_ID)
+        return (doc or {}).get(BOT_DATA_FIELD) or {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        conversations = {}
+        for user_id, doc in (await self._load_active()).items():
+            states = doc[CONVERSATIONS_FIELD].get(name, {})
+            self._conversations.setdefault(int(user_id), {})[name] = dict(states)
+            conversations.update({_decode_key(key): state for key, state in states.items()})
+        return conversations
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        # Ключ розмови закінчується ідентифікатором користувача (per_user=True)
+        user_id = int(key[-1])
+        user_conversations = self._conversations.setdefault(user_id, {})
+        states = user_conversations.setdefault(name, {})
+        if new_state is None:
+            states.pop(_encode_key(key), None)
+        else:
+            states[_encode_key(key)] = new_state
+        # Без незавершених розмов поле стає null, і документ випадає з часткового індексу
+        await self.store.save_conversation_state(user_id, {
+            CONVERSATIONS_FIELD: {handler: dict(keys) for handler, keys in user_conversations.items() if keys} or None
+        })
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self.store.save_conversation_state(user_id, {USER_DATA_FIELD: data})
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self.store.save_conversation_state(BOT_DATA_ID, {BOT_DATA_FIELD: data})
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.store.save_conversation_state(user_id, {USER_DATA_FIELD: {}})
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """Підвантажує user_data користувача, якого ще не було з моменту старту"""
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        doc = await self.store.get_conversation_state(user_id)
+        if doc and doc.get(USER_DATA_FIELD) and not user_data:
+            user_data.update(doc[USER_DATA_FIELD])
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self.store.flush()
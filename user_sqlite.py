@@ -0,0 +1,206 @@
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Any, Iterator, List, Tuple, Union
+
+# Налаштування логування
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    last_update TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_chat_id ON users (chat_id);
+CREATE INDEX IF NOT EXISTS users_last_update ON users (last_update);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER PRIMARY KEY,
+    last_update TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_last_update ON conversations (last_update);
+"""
+
+
+class SQLiteUserData:
+    """Вбудоване сховище користувачів і станів розмов у SQLite (режим WAL).
+
+    Має той самий інтерфейс, що й UserData, тож AsyncUserData і обробники працюють з ним
+    без змін. Кожен запис — окрема транзакція над одним рядком за первинним ключем,
+    а не перезапис усього файлу. Кожен потік пулу має власне з'єднання: у режимі WAL
+    читання з різних потоків ідуть паралельно між собою і з записом, а записи
+    виконуються по одному під блокуванням.
+    """
+
+    def __init__(self, filename: str = "users.sqlite3"):
+        self.filename = filename
+        # Сумісність з UserData: MongoDB не використовується
+        self.client = None
+        self.db = None
+        self.users_collection = None
+        self.conversations = None
+        # Блокування лише для записів: SQLite все одно допускає одного записувача
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self.load_data()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """З'єднання поточного потоку (створюється при першому зверненні)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def load_data(self):
+        """Дані читаються з бази за потреби — лише повідомляємо про кількість"""
+        count = self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        logger.info(f"Підключено SQLite {self.filename}: {count} користувачів")
+
+    def save_data(self):
+        """Кожна зміна вже записана власною транзакцією"""
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def ensure_connected(self) -> bool:
+        """MongoDB у цьому режимі не використовується"""
+        return False
+
+    def users_page(self, after: str = '', limit: int = 500,
+                   fields: Optional[List[str]] = None) -> List[Tuple[str, dict]]:
+        """Сторінка користувачів з user_id більшим за after (пошук за первинним ключем, без OFFSET)"""
+        rows = self._conn.execute(
+            "SELECT user_id, data FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (int(after) if after else -1, limit)
+        ).fetchall()
+        page = []
+        for user_id, data in rows:
+            user = json.loads(data)
+            user.pop('_id', None)
+            page.append((str(user_id), {k: v for k, v in user.items() if fields is None or k in fields}))
+        return page
+
+    def iter_users(self, fields: Optional[List[str]] = None, page_size: int = 500) -> Iterator[Tuple[str, dict]]:
+        """Перебирає всіх користувачів сторінками"""
+        after = ''
+        while True:
+            page = self.users_page(after, page_size, fields)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    def _read(self, table: str, user_id: int) -> Optional[dict]:
+        row = self._conn.execute(f"SELECT data FROM {table} WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _update(self, table: str, user_id: int, changes: Dict[str, Any]) -> dict:
+        """Оновлює лише передані поля запису (як $set з upsert); викликається під self._lock"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            data = self._read(table, user_id) or {}
+            data.update(changes)
+            last_update = str(data.get('last_update') or datetime.now().isoformat())
+            payload = json.dumps(data, ensure_ascii=False, default=str)
+            if table == 'users':
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO users (user_id, chat_id, last_update, data) VALUES (?, ?, ?, ?)",
+                    (user_id, data.get('chat_id'), last_update, payload)
+                )
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO conversations (user_id, last_update, data) VALUES (?, ?, ?)",
+                    (user_id, last_update, payload)
+                )
+            self._conn.execute("COMMIT")
+            return data
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def save_conversation_state(self, user_id: int, state: Dict[str, Any]) -> bool:
+        """Зберігає стан розмови користувача"""
+        try:
+            state['user_id'] = int(user_id)
+            state['last_update'] = datetime.now().isoformat()
+            with self._lock:
+                self._update('conversations', int(user_id), state)
+            return True
+        except Exception as e:
+            logger.error(f"Помилка збереження стану розмови: {str(e)}")
+            return False
+
+    def get_conversation_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Отримує стан розмови користувача"""
+        try:
+            return self._read('conversations', int(user_id))
+        except Exception as e:
+            logger.error(f"Помилка отримання стану розмови: {str(e)}")
+            return None
+
+    def conversation_docs(self, field: str, since: Optional[str] = None) -> List[Tuple[str, dict]]:
+        """Стани розмов, у яких поле field не порожнє і які змінювались не раніше since"""
+        rows = self._conn.execute(
+            "SELECT user_id, data FROM conversations WHERE json_extract(data, ?) IS NOT NULL AND last_update >= ?",
+            ('$.' + field, since or '')
+        ).fetchall()
+        docs = [(str(user_id), json.loads(data)) for user_id, data in rows]
+        return [(user_id, doc) for user_id, doc in docs if doc.get(field)]
+
+    def clear_conversation_state(self, user_id: Union[str, int]) -> None:
+        """Очищає стан розмови для конкретного користувача"""
+        try:
+            with self._lock:
+                self._update('conversations', int(user_id), {
+                    'user_id': int(user_id), 'state': {}, 'last_updated': datetime.now().isoformat()
+                })
+        except Exception as e:
+            logger.error(f"Помилка при очищенні стану розмови для користувача {user_id}: {e}")
+
+    def add_user(self, user_id: int, user_info: dict) -> bool:
+        """Додає нового користувача або оновлює існуючого, не затираючи старі дані"""
+        try:
+            with self._lock:
+                existing = self._read('users', int(user_id)) or {}
+                changes = dict(user_info)
+                # Не перезаписуємо created_at, якщо він вже існує
+                changes['created_at'] = existing.get('created_at', datetime.now().isoformat())
+                changes['_id'] = str(user_id)
+                changes['user_id'] = int(user_id)
+                self._update('users', int(user_id), changes)
+            logger.info(f"Додано/оновлено користувача: {user_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Помилка додавання користувача: {str(e)}")
+            return False
+
+    def get_user(self, user_id: int) -> Optional[dict]:
+        """Отримує інформацію про користувача"""
+        try:
+            user = self._read('users', int(user_id))
+            if user:
+                user.pop('_id', None)
+            return user
+        except Exception as e:
+            logger.error(f"Помилка отримання користувача: {str(e)}")
+            return None